@@ -228,6 +228,7 @@ static u64 stage_finds[32],           /* Patterns found per fuzz stage    */
            stage_cycles[32];          /* Execs per fuzz stage             */
 
 u32 rand_cnt;                         /* Random number counter (exported for random.h) */
+u8  fixed_seed;                       /* AFL_FIXED_SEED given? (exported for random.h) */
 
 static u64 total_cal_us,              /* Total calibration time (us)      */
            total_cal_cycles;          /* Total calibration cycles         */
@@ -270,6 +271,9 @@ struct queue_entry {
   u8* trace_mini;                     /* Trace bytes, if kept             */
   u32 tc_ref;                         /* Trace bytes ref count            */
 
+  u8* cov_bits;                       /* Coverage bitmap for the model    */
+  double py_score;                    /* Model's perf score multiplier    */
+
   /* The follow fields exist to support alias tables for fast random number
      generation according to an arbitrary probability distribution. Utilized
      when picking offsets to mutate in havoc stage.  */
@@ -841,9 +845,9 @@ EXP_ST void destroy_queue(void) {
     n = q->next;
     ck_free(q->fname);
     ck_free(q->alias.fname);
-    ck_free(q->alias.prob_table);
-    ck_free(q->alias.alias_table);
+    free_alias_tables(&q->alias);
     ck_free(q->trace_mini);
+    ck_free(q->cov_bits);
     ck_free(q);
     q = n;
 
@@ -1248,6 +1252,103 @@ static void minimize_bits(u8* dst, u8* src) {
 }
 
 
+/* Remember the current trace_bits as the reference coverage of a queue entry
+   for classify_cov_change(). Only needed when the python model is listening
+   for post fuzz callbacks. */
+
+static void save_cov_bits(struct queue_entry* q) {
+
+  if (!py_post_fuzz_callback) return;
+
+  if (!q->cov_bits) q->cov_bits = ck_alloc(MAP_SIZE >> 3);
+  else memset(q->cov_bits, 0, MAP_SIZE >> 3);
+
+  minimize_bits(q->cov_bits, trace_bits);
+
+}
+
+
+/* Classify how the current trace_bits differ from the reference coverage of
+   a queue entry into one of the COV_* codes, following the same rules as
+   WAflModel._calc_cov_change(). The number of edges gained and lost is
+   returned through the pointers, and the indices of up to COV_MAX_EDGES
+   changed edges are stored in edges. When more edges changed, edges holds a
+   uniform sample of them (reservoir sampling with a private generator, so
+   afl's own random stream is left alone) rather than the lowest indices.
+   This is called after every exec, so it works a word at a time and skips
+   empty regions of the map. */
+
+static s32 classify_cov_change(struct queue_entry* q, u32* gained, u32* lost,
+                               u32* edges, u32* edges_cnt) {
+
+  static u8  no_cov[MAP_SIZE >> 3];
+  static u32 sample_rng = 0x9e3779b9;
+
+  u64* cur = (u64*)trace_bits;
+  u8*  old = q->cov_bits ? q->cov_bits : no_cov;
+  u32  i   = (MAP_SIZE >> 3);
+  u32  g   = 0, l = 0, e = 0;
+
+  while (i--) {
+
+    u64 v = *(cur++);
+    u8  o = *(old++);
+    u8  n, d;
+
+    if (!v && !o) continue;
+
+    /* Collapse every non-zero byte into its lowest bit, then gather the
+       eight low bits into a single byte, laid out like minimize_bits(). */
+
+    v |= v >> 4;
+    v |= v >> 2;
+    v |= v >> 1;
+    v &= 0x0101010101010101ULL;
+    n  = (v * 0x0102040810204080ULL) >> 56;
+
+    g += __builtin_popcount(n & ~o);
+    l += __builtin_popcount(o & ~n);
+
+    for (d = n ^ o; d; d &= d - 1, e++) {
+
+      u32 edge = (((MAP_SIZE >> 3) - 1 - i) << 3) + __builtin_ctz(d);
+
+      if (e < COV_MAX_EDGES) {
+
+        edges[e] = edge;
+
+      } else {
+
+        /* xorshift32 */
+        u32 r;
+        sample_rng ^= sample_rng << 13;
+        sample_rng ^= sample_rng >> 17;
+        sample_rng ^= sample_rng << 5;
+        r = sample_rng % (e + 1);
+        if (r < COV_MAX_EDGES) edges[r] = edge;
+
+      }
+
+    }
+
+  }
+
+  *gained    = g;
+  *lost      = l;
+  *edges_cnt = MIN(e, COV_MAX_EDGES);
+
+  if (!g && !l) return COV_NO_CHANGE;
+
+  /* The new coverage count is the old one plus gains minus losses. */
+
+  if (g > l) return l ? COV_SOFT_INCREASE : COV_INCREASE;
+  if (g < l) return g ? COV_SOFT_DECREASE : COV_DECREASE;
+
+  return COV_CHANGE;
+
+}
+
+
 /* When we bump into a new path, we call this to see if the path appears
    more "favorable" than any of the existing ones. The purpose of the
    "favorables" is to have a minimal set of paths that trigger all the bits
@@ -2679,6 +2780,13 @@ static u8 calibrate_case(char** argv, struct queue_entry* q, u8* use_mem,
 
   if (!dumb_mode && first_run && !fault && !new_bits) fault = FAULT_NOBITS;
 
+  /* The model decides whether reference coverage is kept, so a file deferred
+     by AFL_PYTHON_LAZY has to be loaded before the first entry's is saved. */
+
+  load_lazy_python_file();
+
+  save_cov_bits(q);
+
   call_py_new_entry_callback(
     q->id, fault,
     q->fname, q->fname ? strlen(q->fname) : 0,
@@ -3478,7 +3586,9 @@ static void write_stats_file(double bitmap_cvg, double stability, double eps) {
              "afl_version       : " VERSION "\n"
              "target_mode       : %s%s%s%s%s%s%s\n"
              "command_line      : %s\n"
-             "slowest_exec_ms   : %llu\n",
+             "slowest_exec_ms   : %llu\n"
+             "python_time_ms    : %llu\n"
+             "python_startup_ms : %llu\n",
              start_time / 1000, get_cur_time() / 1000, getpid(),
              queue_cycle ? (queue_cycle - 1) : 0, total_execs, eps,
              queued_paths, queued_favored, queued_discovered, queued_imported,
@@ -3492,7 +3602,8 @@ static void write_stats_file(double bitmap_cvg, double stability, double eps) {
              persistent_mode ? "persistent " : "", deferred_mode ? "deferred " : "",
              (qemu_mode || dumb_mode || no_forkserver || crash_mode ||
               persistent_mode || deferred_mode) ? "" : "default",
-             orig_cmdline, slowest_exec_ms);
+             orig_cmdline, slowest_exec_ms, py_callback_us / 1000,
+             py_startup_us / 1000);
              /* ignore errors */
 
   /* Get rss value from the children
@@ -4540,6 +4651,8 @@ static u8 trim_case(char** argv, struct queue_entry* q, u8* in_buf) {
   u32 trim_exec = 0;
   u32 remove_len;
   u32 len_p2;
+  u32 orig_len = q->len;
+  u32* orig_off = NULL;
 
   /* Although the trimmer will be less useful when variable behavior is
      detected, it will still work to some extent, so we don't check for
@@ -4547,6 +4660,18 @@ static u8 trim_case(char** argv, struct queue_entry* q, u8* in_buf) {
 
   if (q->len < 5) return 0;
 
+  /* Track where each remaining byte came from, so the model can be told
+     which ranges were removed. */
+
+  if (py_trim_callback) {
+
+    u32 i;
+
+    orig_off = ck_alloc(q->len * sizeof(u32));
+    for (i = 0; i < q->len; i++) orig_off[i] = i;
+
+  }
+
   stage_name = tmp;
   bytes_trim_in += q->len;
 
@@ -4599,6 +4724,10 @@ static u8 trim_case(char** argv, struct queue_entry* q, u8* in_buf) {
         memmove(in_buf + remove_pos, in_buf + remove_pos + trim_avail,
                 move_tail);
 
+        if (orig_off)
+          memmove(orig_off + remove_pos, orig_off + remove_pos + trim_avail,
+                  move_tail * sizeof(u32));
+
         /* Let's save a clean trace, which will be needed by
            update_bitmap_score once we're done with the trimming stuff. */
 
@@ -4643,21 +4772,58 @@ static u8 trim_case(char** argv, struct queue_entry* q, u8* in_buf) {
 
     /* re-initialize the alias table since length changed */
     q->alias.length = q->len;
-    ck_free(q->alias.alias_table); q->alias.alias_table = NULL;
-    ck_free(q->alias.prob_table); q->alias.prob_table = NULL;
+    free_alias_tables(&q->alias);
+
+    save_cov_bits(q);
 
-    /* pretend like this is a new entry */
-    call_py_new_entry_callback(
-      q->id, fault,
-      q->fname, q->fname ? strlen(q->fname) : 0,
-      q->alias.fname, q->alias.fname ? strlen(q->alias.fname) : 0,
-      in_buf, q->len,
-      trace_bits, MAP_SIZE);
+    if (orig_off) {
+
+      /* Turn the gaps in orig_off into (offset, length) pairs. */
+
+      u32* removed = ck_alloc((q->len + 1) * 2 * sizeof(u32));
+      u32 removed_cnt = 0, next_off = 0, i;
+
+      for (i = 0; i <= q->len; i++) {
+
+        u32 off = i < q->len ? orig_off[i] : orig_len;
+
+        if (off != next_off) {
+          removed[removed_cnt * 2]     = next_off;
+          removed[removed_cnt * 2 + 1] = off - next_off;
+          removed_cnt++;
+        }
+
+        next_off = off + 1;
+
+      }
+
+      call_py_trim_callback(
+        q->id, fault,
+        q->fname, q->fname ? strlen(q->fname) : 0,
+        q->alias.fname, q->alias.fname ? strlen(q->alias.fname) : 0,
+        in_buf, q->len,
+        trace_bits, MAP_SIZE,
+        removed, removed_cnt);
+
+      ck_free(removed);
+
+    } else {
+
+      /* pretend like this is a new entry */
+      call_py_new_entry_callback(
+        q->id, fault,
+        q->fname, q->fname ? strlen(q->fname) : 0,
+        q->alias.fname, q->alias.fname ? strlen(q->alias.fname) : 0,
+        in_buf, q->len,
+        trace_bits, MAP_SIZE);
+
+    }
 
   }
 
 abort_trimming:
 
+  ck_free(orig_off);
   bytes_trim_out += q->len;
   return fault;
 
@@ -4682,6 +4848,10 @@ EXP_ST u8 common_fuzz_stuff(char** argv, u8* out_buf, u32 len) {
   write_to_testcase(out_buf, len);
 
   fault = run_target(argv, exec_tmout);
+
+  /* The model can ask to stop training on a seed (see SEED_UNIFORM). */
+  u8 py_training = py_post_fuzz_callback && !queue_cur->alias.uniform;
+
   #if 0
   u32 cksum = 0;
   #else
@@ -4689,10 +4859,18 @@ EXP_ST u8 common_fuzz_stuff(char** argv, u8* out_buf, u32 len) {
   // save_if_interesting when new bits are found (has_new_bits).  For some cases
   // it may be slower (less than 10%) to do this here but in general it is a
   // speed up if the Python callback takes advantage of the checksum.
-  u32 cksum = hash32(trace_bits, MAP_SIZE, HASH_CONST);
+  u32 cksum = py_training ? hash32(trace_bits, MAP_SIZE, HASH_CONST) : 0;
   #endif
-  call_py_post_fuzz_callback(queue_cur->id, fault, out_buf, len, trace_bits, MAP_SIZE, splicing_with, (u8*)mutation_sequence, sizeof(mutation_sequence),
-    queue_cur->exec_cksum, cksum);
+  if (py_training) {
+
+    u32 cov_gained, cov_lost, cov_edges[COV_MAX_EDGES], cov_edges_cnt;
+    s32 cov_class = classify_cov_change(queue_cur, &cov_gained, &cov_lost,
+                                        cov_edges, &cov_edges_cnt);
+
+    call_py_post_fuzz_callback(queue_cur->id, fault, out_buf, len, trace_bits, MAP_SIZE, splicing_with, (u8*)mutation_sequence, sizeof(mutation_sequence),
+      queue_cur->exec_cksum, cksum, cov_class, cov_gained, cov_lost, cov_edges, cov_edges_cnt);
+
+  }
 
   if (stop_soon) return 1;
 
@@ -4833,6 +5011,11 @@ static u32 calculate_score(struct queue_entry* q) {
 
   }
 
+  /* Let the model shift havoc time towards entries whose learned offsets
+     keep finding new coverage. */
+
+  if (q->py_score > 0) perf_score *= q->py_score;
+
   /* Make sure that we don't go over limit. */
 
   if (perf_score > HAVOC_MAX_MULT * 100) perf_score = HAVOC_MAX_MULT * 100;
@@ -5033,7 +5216,8 @@ static u8 could_be_interest(u32 old_val, u32 new_val, u8 blen, u8 check_le) {
 static void update_alias_table_q(struct queue_entry* entry) {
 
   struct alias* alias = &entry->alias;
-  update_alias_table(alias->fname, &alias->length, &alias->alias_table, &alias->prob_table);
+  if (alias->uniform) return; /* URa() won't look at the tables */
+  update_alias_table(alias);
   if(alias->length != entry->len) {
     FATAL("alias table length (%d) and buffer length (%d) out of sync", alias->length, entry->len);
   }
@@ -5103,7 +5287,22 @@ static u8 fuzz_one(char** argv) {
     fflush(stdout);
   }
 
-  call_py_notify_callback(NOTIFY_SEED_START, queue_cur->id);
+  /* Ask the model how much havoc time this entry is worth.  It may only
+     skip entries that have been fuzzed before. */
+
+  queue_cur->py_score = call_py_score_callback(queue_cur->id);
+
+  if (queue_cur->py_score <= 0 && queue_cur->was_fuzzed) return 1;
+
+  /* Execs before havoc have no mutation sequence. */
+
+  reset_mutation_sequence();
+
+  /* The model may give up on a seed for now and have us sample it
+     uniformly without training callbacks. */
+
+  queue_cur->alias.uniform =
+    !!(call_py_notify_callback(NOTIFY_SEED_START, queue_cur->id) & SEED_UNIFORM);
 
   /* Map the test case into memory. */
 
@@ -6255,7 +6454,7 @@ havoc_stage:
         case 0: ; // Declarations can't directly follow labels
 
           /* Flip a single bit somewhere. Spooky! */
-          position = (URa(temp_len, alias) << 3) + UR(8);
+          position = (URa(temp_len, ALIAS_BYTE, alias) << 3) + UR(8);
           mutation_sequence[mutation_step][0] = mutation_decision;
           mutation_sequence[mutation_step][1] = position;
           mutation_step++;
@@ -6267,7 +6466,7 @@ havoc_stage:
         case 1: ; // Declarations can't directly follow labels
 
           /* Set byte to interesting value. */
-          position = URa(temp_len, alias);
+          position = URa(temp_len, ALIAS_BYTE, alias);
           int interesting_byte = interesting_8[UR(sizeof(interesting_8))];
           mutation_sequence[mutation_step][0] = mutation_decision;
           mutation_sequence[mutation_step][1] = position;
@@ -6285,7 +6484,7 @@ havoc_stage:
           if (temp_len < 2) break;
 
           swap_or_not = UR(2);
-          int word_offset = URa(temp_len - 1, alias);
+          int word_offset = URa(temp_len - 1, ALIAS_WORD, alias);
           int word_value;
 
           if (swap_or_not) {
@@ -6315,7 +6514,7 @@ havoc_stage:
           if (temp_len < 4) break;
 
           swap_or_not = UR(2);
-          int dword_offset = URa(temp_len - 3, alias);
+          int dword_offset = URa(temp_len - 3, ALIAS_DWORD, alias);
           int dword_value;
 
           if (swap_or_not) {
@@ -6341,7 +6540,7 @@ havoc_stage:
         case 4: ;
 
           /* Randomly subtract from byte. */
-          position = URa(temp_len, alias);
+          position = URa(temp_len, ALIAS_BYTE, alias);
           subtract_value = 1 + UR(ARITH_MAX);
 
           out_buf[position] -= subtract_value;
@@ -6356,7 +6555,7 @@ havoc_stage:
         case 5:
 
           /* Randomly add to byte. */
-          position = URa(temp_len, alias);
+          position = URa(temp_len, ALIAS_BYTE, alias);
           add_value = 1 + UR(ARITH_MAX);
 
           out_buf[position] += add_value;
@@ -6375,7 +6574,7 @@ havoc_stage:
           if (temp_len < 2) break;
 
           swap_or_not = UR(2);
-          position = URa(temp_len - 1, alias);
+          position = URa(temp_len - 1, ALIAS_WORD, alias);
           subtract_value = 1 + UR(ARITH_MAX);
 
           if (swap_or_not) {
@@ -6404,7 +6603,7 @@ havoc_stage:
           if (temp_len < 2) break;
 
           swap_or_not = UR(2);
-          position = URa(temp_len - 1, alias);
+          position = URa(temp_len - 1, ALIAS_WORD, alias);
           add_value = 1 + UR(ARITH_MAX);
 
 
@@ -6434,7 +6633,7 @@ havoc_stage:
           if (temp_len < 4) break;
 
           swap_or_not = UR(2);
-          position = URa(temp_len - 3, alias);
+          position = URa(temp_len - 3, ALIAS_DWORD, alias);
           subtract_value = 1 + UR(ARITH_MAX);
 
           if (swap_or_not) {
@@ -6463,7 +6662,7 @@ havoc_stage:
           if (temp_len < 4) break;
 
           swap_or_not = UR(2);
-          position = URa(temp_len - 3, alias);
+          position = URa(temp_len - 3, ALIAS_DWORD, alias);
           add_value = 1 + UR(ARITH_MAX);
 
           if (swap_or_not) {
@@ -6491,7 +6690,7 @@ havoc_stage:
              why not. We use XOR with 1-255 to eliminate the
              possibility of a no-op. */
 
-          position = URa(temp_len, alias);
+          position = URa(temp_len, ALIAS_BYTE, alias);
           int xor_val = 1 + UR(255);
 
           out_buf[position] ^= xor_val;
@@ -6806,6 +7005,11 @@ havoc_stage:
 
   alias = 0; /* we shouldn't be using the alias table after this point */
 
+  /* Only havoc execs have a mutation sequence, don't let later stages report
+     a stale one. */
+
+  reset_mutation_sequence();
+
   new_hit_cnt = queued_paths + unique_crashes;
 
   if (!splice_cycle) {
@@ -6907,7 +7111,7 @@ retry_splicing:
        some normalized combination of the two spliced distributions. */
 
 #if 0
-    if(!target->alias.alias_table || !target->alias.prob_table) FATAL("splice target %d has uninitialized alias|prob table", splicing_with);
+    if(!target->alias.alias_table[ALIAS_BYTE] || !target->alias.prob_table[ALIAS_BYTE]) FATAL("splice target %d has uninitialized alias|prob table", splicing_with);
 #else
     /* update the target's alias table on demand */
     update_alias_table_q(target);
@@ -7518,6 +7722,13 @@ EXP_ST void setup_dirs_fds(void) {
   dev_urandom_fd = open("/dev/urandom", O_RDONLY);
   if (dev_urandom_fd < 0) PFATAL("Unable to open /dev/urandom");
 
+  if (getenv("AFL_FIXED_SEED")) {
+
+    fixed_seed = 1;
+    srandom(atoi(getenv("AFL_FIXED_SEED")));
+
+  }
+
   /* Gnuplot output file. */
 
   tmp = alloc_printf("%s/plot_data", out_dir);
@@ -8231,7 +8442,13 @@ int main(int argc, char** argv) {
 
       case 'P': /* Python script */
 
-        load_python_file(optarg);
+        if (getenv("AFL_PYTHON_LAZY")) {
+
+          if (py_lazy_file) FATAL("Multiple -P options not supported with AFL_PYTHON_LAZY");
+          py_lazy_file = optarg;
+
+        } else load_python_file(optarg);
+
         break;
 
       case 'I': /* Interactive python shell */
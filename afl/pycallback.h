@@ -6,6 +6,8 @@
 
 #include <Python.h>
 #include <libgen.h>
+#include <signal.h>
+#include <sys/time.h>
 
 #if PY_MAJOR_VERSION >= 3
 #define PYTHON3
@@ -22,6 +24,23 @@ call_python_callback(PyObject* py_callback, PyObject* arglist, PyObject** out_re
 #define NOTIFY_SEED_START      3
 #define NOTIFY_SEED_END        4
 
+/* Flags the notify callback can return for NOTIFY_SEED_START. These need to
+   match the SEED_* constants in afl/__init__.py. */
+#define SEED_UNIFORM           1   /* sample uniformly, skip training callbacks */
+
+/* Coverage change classes passed to the post fuzz callback. These need to
+   match the COV_* constants in wafl.py. */
+#define COV_NO_CHANGE         -1
+#define COV_CHANGE             0
+#define COV_INCREASE           1
+#define COV_SOFT_INCREASE      2
+#define COV_SOFT_DECREASE      3
+#define COV_DECREASE           4
+
+/* Maximum number of changed edge indices passed to the post fuzz callback.
+   Larger changes are sampled uniformly across the map (classify_cov_change). */
+#define COV_MAX_EDGES        256
+
 /* defined in afl-fuzz.c */
 static void handle_stop_sig(int sig);
 
@@ -36,26 +55,76 @@ static void handle_stop_sig(int sig);
   } while (0)
 
 
+/* Total wall time spent inside python callbacks (us), reported as
+   python_time_ms in fuzzer_stats. */
+static u64 py_callback_us = 0;
+
+/* While the sampling profiler is on (see afl.profile_timer), SIGPROF is only
+   passed on to python's handler when it interrupts a python callback, so the
+   samples are proportional to where the model spends its time; the ones that
+   land in afl's own code are dropped. */
+static volatile sig_atomic_t py_in_callback = 0;
+static void (*py_prof_chain)(int) = NULL;
+
+static void handle_py_prof_sig(int sig) {
+  if (py_in_callback) py_prof_chain(sig);
+}
+
+/* Wall time spent starting the interpreter and loading python files (us),
+   reported as python_startup_ms in fuzzer_stats. */
+static u64 py_startup_us = 0;
+
+/* With AFL_PYTHON_LAZY, the -P file isn't run until the first queue entry
+   has been calibrated, so the fork server starts before the model and its
+   imports (numpy, xxhash, ...) are loaded.  calibrate_case() loads it before
+   saving the entry's reference coverage, still within the dry run, so this
+   reorders the load rather than removing it from the time to the first
+   fuzzing exec. */
+static char* py_lazy_file = NULL;
+
+static void load_lazy_python_file(void);
+
+
 // ****************************************
 
 static PyObject *py_post_fuzz_callback = 0;
 
+/* Pass the full coverage map to the post fuzz callback? When disabled the
+   callback only gets the coverage change class computed by afl. */
+static u8 py_post_fuzz_want_cov = 1;
+
 static PyObject *
 py_set_post_fuzz_callback(PyObject *self, PyObject *args)
 {
   return set_python_callback(args, &py_post_fuzz_callback);
 }
 
+static PyObject *
+py_set_post_fuzz_coverage(PyObject *self, PyObject *args)
+{
+  int want_cov;
+  if (!PyArg_ParseTuple(args, "i:set_post_fuzz_coverage", &want_cov)) return NULL;
+  py_post_fuzz_want_cov = !!want_cov;
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
 static inline void
-call_py_post_fuzz_callback(u32 id, u8 fault, u8* buf, u32 buf_len, u8* cov, u32 cov_len, u32 splicing_with, u8* seq, u32 seq_len, u32 old_cksum, u32 new_cksum) {
+call_py_post_fuzz_callback(u32 id, u8 fault, u8* buf, u32 buf_len, u8* cov, u32 cov_len, u32 splicing_with, u8* seq, u32 seq_len, u32 old_cksum, u32 new_cksum,
+                           s32 cov_class, u32 cov_gained, u32 cov_lost, u32* cov_edges, u32 cov_edges_cnt) {
 
   if(!py_post_fuzz_callback) return;
 
+  /* a NULL buffer shows up as None on the python side */
+  if(!py_post_fuzz_want_cov) cov = NULL;
+
   call_python_callback(py_post_fuzz_callback,
 #ifdef PYTHON3
-                       Py_BuildValue("(i, i, y#, y#, i, y#, i, i)", id, fault, buf, buf_len, cov, cov_len, splicing_with, seq, seq_len, old_cksum, new_cksum),
+                       Py_BuildValue("(i, i, y#, y#, i, y#, i, i, i, i, i, y#)", id, fault, buf, buf_len, cov, cov_len, splicing_with, seq, seq_len, old_cksum, new_cksum, cov_class, cov_gained, cov_lost,
+                                     (u8*)cov_edges, cov_edges_cnt * sizeof(u32)),
 #else
-                       Py_BuildValue("(i, i, s#, s#, i, s#, i, i)", id, fault, buf, buf_len, cov, cov_len, splicing_with, seq, seq_len, old_cksum, new_cksum),
+                       Py_BuildValue("(i, i, s#, s#, i, s#, i, i, i, i, i, s#)", id, fault, buf, buf_len, cov, cov_len, splicing_with, seq, seq_len, old_cksum, new_cksum, cov_class, cov_gained, cov_lost,
+                                     (u8*)cov_edges, cov_edges_cnt * sizeof(u32)),
 #endif
                        NULL);
 }
@@ -78,6 +147,8 @@ call_py_new_entry_callback(
     u8* buf, u32 buf_len,
     u8* cov, u32 cov_len) {
 
+  load_lazy_python_file();
+
   if(!py_new_entry_callback) return;
 
   call_python_callback(py_new_entry_callback,
@@ -96,6 +167,84 @@ call_py_new_entry_callback(
 
 // ****************************************
 
+static PyObject *py_trim_callback = 0;
+
+static PyObject *
+py_set_trim_callback(PyObject *self, PyObject *args)
+{
+  return set_python_callback(args, &py_trim_callback);
+}
+
+/* Called instead of the new entry callback when trim_case() shrinks an entry.
+   removed holds removed_cnt (offset, length) pairs of the byte ranges that
+   were cut from the untrimmed buffer, in increasing order. */
+
+static inline void
+call_py_trim_callback(
+    u32 id, u8 fault,
+    u8* fname, u32 fname_len,
+    u8* alias_fname, u32 alias_fname_len,
+    u8* buf, u32 buf_len,
+    u8* cov, u32 cov_len,
+    u32* removed, u32 removed_cnt) {
+
+  if(!py_trim_callback) return;
+
+  call_python_callback(py_trim_callback,
+#ifdef PYTHON3
+                       Py_BuildValue("(i, i, y#, y#, y#, y#, y#)",
+#else
+                       Py_BuildValue("(i, i, s#, s#, s#, s#, s#)",
+#endif
+                       id, fault,
+                       fname, fname_len,
+                       alias_fname, alias_fname_len,
+                       buf, buf_len,
+                       cov, cov_len,
+                       (u8*)removed, removed_cnt * 2 * sizeof(u32)),
+                       NULL);
+}
+
+// ****************************************
+
+static PyObject *py_score_callback = 0;
+
+static PyObject *
+py_set_score_callback(PyObject *self, PyObject *args)
+{
+  return set_python_callback(args, &py_score_callback);
+}
+
+/* Asked before an entry is fuzzed.  Returns the multiplier the callback wants
+   applied to the entry's perf score, 1.0 for None or without a callback.  A
+   multiplier of 0 asks to skip the entry this time. */
+
+static inline double
+call_py_score_callback(u32 id) {
+
+  PyObject *result;
+  double ret = 1.0;
+
+  if(!py_score_callback) return 1.0;
+
+  call_python_callback(py_score_callback,
+                       Py_BuildValue("(i)", id),
+                       &result);
+
+  if (result != Py_None) {
+    ret = PyFloat_AsDouble(result);
+    if (ret == -1.0 && PyErr_Occurred()) {
+      PyErr_Print();
+      FATAL_WITH_STOP("score callback must return None or a number");
+    }
+  }
+
+  Py_DECREF(result);
+  return ret;
+}
+
+// ****************************************
+
 static PyObject *py_notify_callback = 0;
 
 static PyObject *
@@ -104,14 +253,81 @@ py_set_notify_callback(PyObject *self, PyObject *args)
   return set_python_callback(args, &py_notify_callback);
 }
 
-static inline void
+/* Returns the callback's result, an int of SEED_* flags, or 0 for None. */
+
+static inline s32
 call_py_notify_callback(u32 type, u32 val) {
 
-  if(!py_notify_callback) return;
+  PyObject *result;
+  s32 ret = 0;
+
+  if(!py_notify_callback) return 0;
 
   call_python_callback(py_notify_callback,
                        Py_BuildValue("(i, i)", type, val),
-                       NULL);
+                       &result);
+
+  if (result != Py_None) {
+#ifdef PYTHON3
+    ret = PyLong_AsLong(result);
+#else
+    ret = PyInt_AsLong(result);
+#endif
+    if (ret == -1 && PyErr_Occurred()) {
+      PyErr_Print();
+      FATAL_WITH_STOP("notify callback must return None or an int");
+    }
+  }
+
+  Py_DECREF(result);
+  return ret;
+}
+
+// ****************************************
+
+static PyObject *
+py_set_profile_timer(PyObject *self, PyObject *args)
+{
+  double interval;
+  struct itimerval it;
+  struct sigaction sa, old;
+
+  if (!PyArg_ParseTuple(args, "d:set_profile_timer", &interval)) return NULL;
+
+  memset(&it, 0, sizeof(it));
+
+  if (interval > 0) {
+
+    /* wrap the handler python installed, unless that's been done already */
+    sigaction(SIGPROF, NULL, &old);
+    if (old.sa_handler != handle_py_prof_sig) {
+
+      if (old.sa_handler == SIG_DFL || old.sa_handler == SIG_IGN) {
+        PyErr_SetString(PyExc_RuntimeError, "install a SIGPROF handler first");
+        return NULL;
+      }
+
+      py_prof_chain = old.sa_handler;
+
+      memset(&sa, 0, sizeof(sa));
+      sa.sa_handler = handle_py_prof_sig;
+      sa.sa_flags   = SA_RESTART;
+      sigemptyset(&sa.sa_mask);
+      sigaction(SIGPROF, &sa, NULL);
+
+    }
+
+    it.it_interval.tv_sec  = (long)interval;
+    it.it_interval.tv_usec = (long)((interval - (long)interval) * 1000000);
+    if (!timerisset(&it.it_interval)) it.it_interval.tv_usec = 1;
+    it.it_value = it.it_interval;
+
+  }
+
+  setitimer(ITIMER_PROF, &it, NULL);
+
+  Py_INCREF(Py_None);
+  return Py_None;
 }
 
 // ****************************************
@@ -121,10 +337,18 @@ call_py_notify_callback(u32 type, u32 val) {
 static PyMethodDef python_AflMethods[] = {
   {"set_post_fuzz_callback", py_set_post_fuzz_callback, METH_VARARGS,
    "Set the AFL post fuzz callback."},
+  {"set_post_fuzz_coverage", py_set_post_fuzz_coverage, METH_VARARGS,
+   "Choose whether the post fuzz callback gets the full coverage map."},
   {"set_new_entry_callback", py_set_new_entry_callback, METH_VARARGS,
    "Set the AFL new entry callback."},
   {"set_notify_callback", py_set_notify_callback, METH_VARARGS,
    "Set the AFL notify callback."},
+  {"set_trim_callback", py_set_trim_callback, METH_VARARGS,
+   "Set the AFL trim callback."},
+  {"set_score_callback", py_set_score_callback, METH_VARARGS,
+   "Set the AFL perf score callback."},
+  {"set_profile_timer", py_set_profile_timer, METH_VARARGS,
+   "Run ITIMER_PROF with the given interval only while python callbacks run."},
   {NULL, NULL, 0, NULL}
 };
 
@@ -164,6 +388,7 @@ static inline void
 call_python_callback(PyObject* py_callback, PyObject* arglist, PyObject** out_result)
 {
   PyObject *result;
+  struct timeval start, end;
 
   if (py_callback == NULL) FATAL_WITH_STOP("py_callback == NULL");
   if (arglist == NULL && PyErr_Occurred()) {
@@ -171,7 +396,12 @@ call_python_callback(PyObject* py_callback, PyObject* arglist, PyObject** out_re
     FATAL_WITH_STOP("arglist == NULL");
   }
 
+  gettimeofday(&start, NULL);
+  py_in_callback = 1;
   result = PyEval_CallObject(py_callback, arglist);
+  py_in_callback = 0;
+  gettimeofday(&end, NULL);
+  py_callback_us += (end.tv_sec - start.tv_sec) * 1000000ULL + end.tv_usec - start.tv_usec;
   if (PyErr_Occurred()) PyErr_Print();
   if (result == NULL) FATAL_WITH_STOP("error calling python callback");
   Py_DECREF(arglist);
@@ -214,6 +444,9 @@ static void init_python(int argc, char** argv) {
   PyObject *m;
   PyObject *sys_path;
   int ret;
+  struct timeval start, end;
+
+  gettimeofday(&start, NULL);
 
 #ifdef PYTHON3
   PyImport_AppendInittab ("_afl", init__afl_module);
@@ -274,6 +507,8 @@ static void init_python(int argc, char** argv) {
   if (PyErr_Occurred()) PyErr_Print();
   if (ret) FATAL("could not add built-in afl python module to __main__");
 
+  gettimeofday(&end, NULL);
+  py_startup_us += (end.tv_sec - start.tv_sec) * 1000000ULL + end.tv_usec - start.tv_usec;
 
 }
 
@@ -292,6 +527,10 @@ static void load_python_file(char* pyfile) {
   int ret;
   char* pyfile2 = ck_strdup(pyfile);
   char* dir = dirname(pyfile2);
+  struct timeval start, end;
+  u64 load_us;
+
+  gettimeofday(&start, NULL);
 
   fp = fopen(pyfile, "r");
   if (!fp) PFATAL("opening python file \"%s\"", pyfile);
@@ -309,6 +548,23 @@ static void load_python_file(char* pyfile) {
   fclose(fp);
   ck_free(pyfile2);
   ck_free(update_path);
+
+  gettimeofday(&end, NULL);
+  load_us = (end.tv_sec - start.tv_sec) * 1000000ULL + end.tv_usec - start.tv_usec;
+  py_startup_us += load_us;
+  OKF("Loaded python file '%s' in %llu ms.", pyfile, load_us / 1000);
+}
+
+/* Load the python file deferred by AFL_PYTHON_LAZY, if any. */
+
+static void load_lazy_python_file(void) {
+
+  char* pyfile = py_lazy_file;
+
+  if (!pyfile) return;
+
+  py_lazy_file = NULL;
+  load_python_file(pyfile);
 }
 
 // ****************************************
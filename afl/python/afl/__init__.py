@@ -11,11 +11,27 @@ NOTIFY_CYCLE_END       = 2
 NOTIFY_SEED_START      = 3
 NOTIFY_SEED_END        = 4
 
+# Flags the notify callback can return for NOTIFY_SEED_START
+SEED_UNIFORM           = 1  # sample the seed uniformly and skip its training callbacks
+
+# Coverage change classes computed by afl (see COV_* in pycallback.h)
+COV_NO_CHANGE          = -1
+COV_CHANGE             = 0
+COV_INCREASE           = 1
+COV_SOFT_INCREASE      = 2
+COV_SOFT_DECREASE      = 3
+COV_DECREASE           = 4
+
+# Maximum number of changed edges reported with a coverage change
+COV_MAX_EDGES          = 256
+
 # Keep track of registered functions to prevent users from overwriting
 # a previously set callback
 _new_entry_fn = None
 _post_fuzz_fn = None
 _notify_fn    = None
+_trim_fn      = None
+_score_fn     = None
 
 def notify_callback(fn):
     """Set a callback for when a cycle or seed change occurs."""
@@ -41,6 +57,38 @@ def post_fuzz_callback(fn):
     _post_fuzz_fn = fn
     return fn
 
+def trim_callback(fn):
+    """Set a callback for when an entry in the queue is trimmed.  Without
+    one, trimmed entries are reported through the new entry callback."""
+    global _trim_fn
+    assert _trim_fn is None or fn is None
+    _afl.set_trim_callback(fn)
+    _trim_fn = fn
+    return fn
+
+def score_callback(fn):
+    """Set a callback asked for a multiplier of an entry's perf score (havoc
+    time) before the entry is fuzzed.  Returning None leaves the score alone
+    and 0 skips an entry that has been fuzzed before."""
+    global _score_fn
+    assert _score_fn is None or fn is None
+    _afl.set_score_callback(fn)
+    _score_fn = fn
+    return fn
+
+def profile_timer(interval):
+    """Start the ITIMER_PROF timer (SIGPROF every interval seconds of CPU time)
+    for the SIGPROF handler installed with signal.signal().  afl only passes
+    on the signals that interrupt a python callback, so the handler always
+    lands in the model's code.  An interval of 0 stops the timer."""
+    _afl.set_profile_timer(float(interval))
+
+def post_fuzz_coverage(enabled):
+    """Choose whether the post fuzz callback gets the full coverage map.  When
+    disabled, the callback's cov argument is None and only the coverage change
+    class computed by afl is available."""
+    _afl.set_post_fuzz_coverage(1 if enabled else 0)
+
 def done(fn):
     import atexit
     """Set a callback for when AFL finishes."""
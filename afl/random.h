@@ -12,11 +12,23 @@
 #include "types.h"
 #include "debug.h"
 
+/* Mutation widths that get an alias table of their own.  The table for a
+   width of n bytes covers the len - n + 1 offsets a mutation of that width
+   can start at, so sampling from it never needs a retry. */
+#define ALIAS_BYTE  0
+#define ALIAS_WORD  1
+#define ALIAS_DWORD 2
+#define ALIAS_WIDTHS 3
+
+static const u32 alias_width[ALIAS_WIDTHS] = { 1, 2, 4 };
+
 struct alias {
   u8*  fname;                       /* File name for the weight vector  */
-  u32  length;                      /* length of {alias,prob}_table     */
-  u32* alias_table;                 /* the actual alias table           */
-  u32* prob_table;                  /* the actual probability table     */
+  u32  length;                      /* buffer length (byte table length)*/
+  u32  widths;                      /* number of width tables loaded    */
+  u8   uniform;                     /* sample with plain UR() instead   */
+  u32* alias_table[ALIAS_WIDTHS];   /* the actual alias tables          */
+  u32* prob_table[ALIAS_WIDTHS];    /* the actual probability tables    */
 };
 
 /* undefine to revert to standard UR() behavior */
@@ -39,6 +51,7 @@ _Static_assert(RAND_MAX >= ALIAS_MAX, "RAND_MAX needs to be bigger than ALIAS_MA
 
 extern s32 dev_urandom_fd;
 extern u32 rand_cnt;
+extern u8  fixed_seed;
 
 /* Generate a random number (from 0 to limit - 1). This may
    have slight bias. */
@@ -49,7 +62,13 @@ static inline u32 UR(u32 limit) {
 
     u32 seed[2];
 
-    ck_read(dev_urandom_fd, &seed, sizeof(seed), "/dev/urandom");
+    /* With AFL_FIXED_SEED the generator was seeded once at startup, so draw
+       the reseed values from it to keep runs reproducible. */
+
+    if (fixed_seed) {
+      seed[0] = random();
+      seed[1] = random();
+    } else ck_read(dev_urandom_fd, &seed, sizeof(seed), "/dev/urandom");
 
     srandom(seed[0]);
     rand_cnt = (RESEED_RNG / 2) + (seed[1] % RESEED_RNG);
@@ -97,47 +116,84 @@ static inline u32 UR_alias(u32 table_length, u32* alias_table, u32* prob_table)
         return alias_table[col];
 }
 
-/* Update the alias and probability tables.  Will allocate new tables if necessary. */
+/* Length of the alias table for mutations of the given width. */
 
-static void update_alias_table(char* fname, u32* table_length, u32** alias_table, u32** prob_table) {
-    s32 fd = open(fname, O_RDONLY);
-    if (fd < 0) {
+static inline u32 alias_table_length(u32 length, u32 slot) {
+  return length >= alias_width[slot] ? length - alias_width[slot] + 1 : 0;
+}
 
-        /* fail if we can't read the file and we don't have a table length */
-        if(!*table_length) PFATAL("Unable to open '%s'", fname);
+/* Free all tables, e.g. because the buffer length changed. */
+
+static void free_alias_tables(struct alias* alias) {
+  for(u32 slot = 0; slot < ALIAS_WIDTHS; slot++) {
+    ck_free(alias->alias_table[slot]); alias->alias_table[slot] = NULL;
+    ck_free(alias->prob_table[slot]); alias->prob_table[slot] = NULL;
+  }
+  alias->widths = 0;
+}
 
-        u32 len = *table_length * sizeof(u32);
+/* Update the alias and probability tables.  Will allocate new tables if
+   necessary.  The file holds one (u32 length, u32 alias[length], u32
+   prob[length]) record per width in ALIAS_BYTE, ALIAS_WORD, ALIAS_DWORD
+   order.  Files with just the byte table are fine; word and dword offsets
+   are then drawn from the byte table. */
+
+static void update_alias_table(struct alias* alias) {
+  s32 fd = open(alias->fname, O_RDONLY);
+  if (fd < 0) {
+
+    /* fail if we can't read the file and we don't have a table length */
+    if(!alias->length) PFATAL("Unable to open '%s'", alias->fname);
+
+    /* keep the tables we have, or initialize all widths to uniform */
+    if(alias->widths) return;
+
+    for(u32 slot = 0; slot < ALIAS_WIDTHS; slot++) {
+      u32 table_length = alias_table_length(alias->length, slot);
+      u32 len = table_length * sizeof(u32);
+      if(!alias->alias_table[slot]) alias->alias_table[slot] = ck_alloc(len);
+      if(!alias->prob_table[slot]) alias->prob_table[slot] = ck_alloc(len);
+      for(u32 i = 0; i < table_length; i++) {
+        alias->alias_table[slot][i] = i;
+        alias->prob_table[slot][i] = 0;
+      }
+    }
+    alias->widths = ALIAS_WIDTHS;
 
-        /* alloc and init alias table if necessary */
-        if(!*alias_table) {
-            *alias_table = ck_alloc(len);
-            /* initialize table to uniform */
-            for(u32 i = 0; i < *table_length; i++) { (*alias_table)[i] = i; }
-        }
+  } else {
 
-        /* alloc and init probability table if necessary */
-        if(!*prob_table) {
-            *prob_table = ck_alloc(len);
-            for(u32 i = 0; i < *table_length; i++) { (*prob_table)[i] = 0; }
-        }
+    u32 new_length;
+    ck_read(fd, &new_length, sizeof(new_length), alias->fname);
+    if(alias->length && new_length != alias->length)
+        FATAL("length of alias table in '%s' changed from %d to %d", alias->fname, alias->length, new_length);
+    alias->length = new_length;
 
-    } else {
+    u32 slot;
+    for(slot = 0; slot < ALIAS_WIDTHS; slot++) {
 
-        u32 new_length;
-        ck_read(fd, &new_length, sizeof(new_length), fname);
-        if(*table_length && new_length != *table_length)
-            FATAL("length of alias table in '%s' changed from %d to %d", fname, *table_length, new_length);
+      u32 table_length = new_length;
 
-        u32 len = new_length * sizeof(u32);
-        if(!*alias_table) *alias_table = ck_alloc(len);
-        if(!*prob_table) *prob_table = ck_alloc(len);
-        ck_read(fd, *alias_table, len, fname);
-        ck_read(fd, *prob_table, len, fname);
-        close(fd);
+      if(slot) {
+        s32 res = read(fd, &table_length, sizeof(table_length));
+        if(!res) break; /* no tables for wider mutations */
+        if(res != sizeof(table_length)) PFATAL("Short read from %s", alias->fname);
+        if(table_length != alias_table_length(new_length, slot))
+            FATAL("width %u alias table in '%s' has length %u, expected %u", alias_width[slot],
+                  alias->fname, table_length, alias_table_length(new_length, slot));
+      }
 
-        *table_length = new_length;
+      u32 len = table_length * sizeof(u32);
+      if(!alias->alias_table[slot]) alias->alias_table[slot] = ck_alloc(len);
+      if(!alias->prob_table[slot]) alias->prob_table[slot] = ck_alloc(len);
+      ck_read(fd, alias->alias_table[slot], len, alias->fname);
+      ck_read(fd, alias->prob_table[slot], len, alias->fname);
 
     }
+    close(fd);
+
+    alias->widths = slot;
+
+  }
 }
 
 
@@ -146,29 +202,41 @@ static void update_alias_table(char* fname, u32* table_length, u32** alias_table
 
 #ifndef ALIAS_USE_TABLES
 
-static inline u32 URa(u32 limit, struct alias* alias) {
+static inline u32 URa(u32 limit, u32 slot, struct alias* alias) {
+  (void)(slot);
   (void)(alias);
   return UR(limit);
 }
 
 #else
 
-static inline u32 URa(u32 limit, struct alias* alias) {
+/* Pick the start offset of a mutation that is alias_width[slot] bytes wide;
+   limit is the number of valid offsets. */
+
+static inline u32 URa(u32 limit, u32 slot, struct alias* alias) {
 
   u32 ret;
   u32 retries = ALIAS_MAX_RETRIES;
 
 #ifdef ALIAS_DO_CHECKS
   if(!alias) FATAL("alias table is NULL");
-  if(limit > alias->length) FATAL("alias table lengths got messed up");
+  if(!alias->uniform && limit > alias_table_length(alias->length, slot)) FATAL("alias table lengths got messed up");
 #endif
 
+  /* the model gave up on this seed for now */
+  if(alias->uniform) return UR(limit);
+
   /* Skip the alias code on small buffers. This makes it less likely that we
   will do a bunch of retries trying to hit a single value in a small buffer. */
   if(limit < ALIAS_THRESHOLD) return UR(limit);
 
+  /* every outcome of a table for this width is a valid offset */
+  if(slot < alias->widths && limit == alias_table_length(alias->length, slot))
+    return UR_alias(limit, alias->alias_table[slot], alias->prob_table[slot]);
+
+  /* otherwise fall back to rejection sampling from the byte table */
   do {
-    ret = UR_alias(alias->length, alias->alias_table, alias->prob_table);
+    ret = UR_alias(alias->length, alias->alias_table[ALIAS_BYTE], alias->prob_table[ALIAS_BYTE]);
   } while(ret >= limit && (--retries) > 0);
 
 #if 0
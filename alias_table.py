@@ -2,13 +2,14 @@ import numpy as np
 import struct
 import random
 
-# pip install Vose-Alias-Method
-from vose_sampler import VoseAlias
-
 # needs to match the value in (afl's) random.h
 ALIAS_MAX = 1<<30
 
 def weights2alias(w):
+    # pip install Vose-Alias-Method (imported here, it's slow to import and
+    # only needed once a seed's weights are written)
+    from vose_sampler import VoseAlias
+
     # np.array(dtype=float64) -> dict of {outcome:proportion}
     dist = dict(enumerate(w))
 
@@ -26,11 +27,22 @@ def weights2alias(w):
 
     return alias, prob
 
+# widths (in bytes) of the mutations with their own alias table, in file
+# order.  Needs to match alias_width in (afl's) random.h.
+ALIAS_WIDTHS = (1, 2, 4)
+
 def write_alias(alias, prob, path):
+    write_alias_tables([(alias, prob)], path)
+
+def write_alias_tables(tables, path):
+    """Write one (alias, prob) table per width in ALIAS_WIDTHS.  The tables
+    for wider mutations may be left off, afl then falls back to the byte
+    table for them."""
     with open(path, 'wb') as f:
-        f.write(struct.pack('@I', len(alias)))
-        f.write(alias.tobytes())
-        f.write(prob.tobytes())
+        for alias, prob in tables:
+            f.write(struct.pack('@I', len(alias)))
+            f.write(alias.tobytes())
+            f.write(prob.tobytes())
 
 def read_alias(path):
     def read_fmt(fmt, f):
@@ -42,6 +54,21 @@ def read_alias(path):
         prob = np.frombuffer(f.read(length * 4), dtype=np.uint32, count=length)
     return alias, prob
 
+def read_alias_tables(path):
+    """Read all (alias, prob) tables of a file, byte table first"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    tables = []
+    pos = 0
+    while pos < len(data):
+        length = struct.unpack_from('@I', data, pos)[0]
+        pos += 4
+        alias = np.frombuffer(data, dtype=np.uint32, count=length, offset=pos)
+        prob = np.frombuffer(data, dtype=np.uint32, count=length, offset=pos + 4*length)
+        pos += 8*length
+        tables.append((alias, prob))
+    return tables
+
 # This class can be used to read and sample from the saved alias tables in
 # out/queue/.state/offset_weights/
 class AliasTable(object):
@@ -0,0 +1,166 @@
+"""
+Record the callbacks afl makes into the model so they can be replayed offline,
+e.g. by wafl_sweep.py.
+
+A recording is a directory with two files:
+
+* events.npy: one EVENT_DTYPE record per callback
+* data.bin:   the buffers referenced by the events (offset, length), each
+              followed by nedges uint32s: a training vector's changed edges
+              or the (offset, length) ranges removed by a trim
+
+Coverage maps and mutation sequences are not recorded; replays rely on the
+coverage change class computed by afl instead.
+
+Every training vector carries its buffer and changed edges, so a full
+recording grows with the exec rate (about 6 MB/s on the zlib example).  Most
+of the vectors gain no coverage; a recorder with a quota only keeps the first
+few of those per seed visit, and every vector that gained coverage.
+"""
+
+import numpy as np
+import os
+import struct
+
+from wafl_interface import CovChange
+
+# these need to match afl/python/afl/__init__.py
+NOTIFY_CYCLE_START = 1
+NOTIFY_CYCLE_END = 2
+NOTIFY_SEED_START = 3
+NOTIFY_SEED_END = 4
+
+# these need to match afl/python/afl/__init__.py
+COV_INCREASE = 1
+COV_SOFT_INCREASE = 2
+
+EVENT_NEW_SEED = 0
+EVENT_TRAINING = 1
+EVENT_NOTIFY = 2
+EVENT_TRIM = 3
+
+EVENT_DTYPE = np.dtype([
+    ('kind', '<i4'),      # EVENT_*
+    ('id', '<i4'),        # seed id, or the notification's value
+    ('arg', '<i4'),       # fault (new seed, trim), splicing_with (training), notification type
+    ('code', '<i4'),      # COV_* code of a training vector
+    ('old_cksum', '<u4'),
+    ('new_cksum', '<u4'),
+    ('gained', '<u4'),    # edges gained/lost by a training vector
+    ('lost', '<u4'),
+    ('nedges', '<u4'),    # number of uint32s stored after the buffer
+    ('offset', '<i8'),    # location of the buffer in data.bin
+    ('length', '<i8'),
+    ])
+
+# same layout as EVENT_DTYPE, for fast appends
+_EVENT_STRUCT = struct.Struct('<iiiiIIIIIqq')
+assert _EVENT_STRUCT.size == EVENT_DTYPE.itemsize
+
+class CallbackRecorder(object):
+    """Appends callbacks to a recording directory.
+
+    If quota is set, only that many training vectors that gained no coverage
+    are recorded per seed visit and the rest are counted in skipped.  Replays
+    of such a recording see fewer penalties than the live run did."""
+
+    def __init__(self, path, quota=None):
+        self.path = path
+        self.quota = quota
+        self._no_gain = 0
+        self.skipped = 0
+        try: os.makedirs(self.path)
+        except OSError: pass
+        self._events = open(os.path.join(self.path, 'events.raw'), 'wb')
+        self._data = open(os.path.join(self.path, 'data.bin'), 'wb')
+        self._offset = 0
+        self.count = 0
+
+    def _append(self, kind, _id, arg=0, code=0, old_cksum=0, new_cksum=0, gained=0, lost=0, buf=b'', edges=b''):
+        self._events.write(_EVENT_STRUCT.pack(kind, _id, arg, code,
+                                              old_cksum & 0xffffffff, new_cksum & 0xffffffff,
+                                              gained, lost, len(edges) // 4, self._offset, len(buf)))
+        if buf:
+            self._data.write(buf)
+            self._offset += len(buf)
+        if edges:
+            self._data.write(edges)
+            self._offset += len(edges)
+        self.count += 1
+
+    def new_seed(self, seed_id, fault, buf):
+        self._append(EVENT_NEW_SEED, seed_id, arg=fault, buf=buf)
+
+    def training(self, seed_id, buf, splicing_with, old_cksum, new_cksum, cov_class, cov_gained, cov_lost, cov_edges):
+        if self.quota is not None and cov_class not in (COV_INCREASE, COV_SOFT_INCREASE):
+            if self._no_gain >= self.quota:
+                self.skipped += 1
+                return
+            self._no_gain += 1
+        self._append(EVENT_TRAINING, seed_id, arg=splicing_with, code=cov_class,
+                     old_cksum=old_cksum, new_cksum=new_cksum,
+                     gained=cov_gained, lost=cov_lost, buf=buf, edges=cov_edges)
+
+    def trim(self, seed_id, fault, buf, removed):
+        self._append(EVENT_TRIM, seed_id, arg=fault, buf=buf, edges=removed)
+
+    def notify(self, _type, _id):
+        if _type == NOTIFY_SEED_START:
+            self._no_gain = 0
+        self._append(EVENT_NOTIFY, _id, arg=_type)
+
+    def flush(self):
+        self._events.flush()
+        self._data.flush()
+
+    def close(self):
+        """Finish the recording by writing events.npy"""
+        if self._events.closed: return
+        if self.skipped:
+            print ('recorder: skipped %d training vectors over the quota' % self.skipped)
+        self._events.close()
+        self._data.close()
+        raw = os.path.join(self.path, 'events.raw')
+        events = np.fromfile(raw, dtype=EVENT_DTYPE)
+        np.save(os.path.join(self.path, 'events.npy'), events)
+        os.remove(raw)
+
+def load_recording(path):
+    """Memory map a recording, returning (events, data)"""
+    events = np.load(os.path.join(path, 'events.npy'), mmap_mode='r')
+    data_fname = os.path.join(path, 'data.bin')
+    if os.path.getsize(data_fname):
+        data = np.memmap(data_fname, dtype=np.uint8, mode='r')
+    else:
+        data = np.zeros(0, dtype=np.uint8)
+    return events, data
+
+def replay(model, events, data):
+    """Feed a recording through a model's WAfl API"""
+    for e in events:
+        kind = e['kind']
+        if kind == EVENT_TRAINING:
+            end = e['offset'] + e['length']
+            buf = data[e['offset']:end]
+            edges = data[end:end + 4*e['nedges']]
+            splicing_with = None if e['arg'] == -1 else int(e['arg'])
+            model.got_training(int(e['id']), buf, None, None, splicing_with,
+                               int(e['old_cksum']), int(e['new_cksum']),
+                               CovChange(int(e['code']), int(e['gained']), int(e['lost']), edges))
+        elif kind == EVENT_NEW_SEED:
+            buf = data[e['offset']:e['offset'] + e['length']]
+            model.got_new_seed(int(e['id']), buf, None)
+        elif kind == EVENT_TRIM:
+            end = e['offset'] + e['length']
+            removed = np.frombuffer(data[end:end + 4*e['nedges']], dtype=np.uint32).reshape(-1, 2)
+            model.got_trimmed_seed(int(e['id']), data[e['offset']:end], None, removed)
+        elif kind == EVENT_NOTIFY:
+            _type, _id = e['arg'], int(e['id'])
+            if _type == NOTIFY_SEED_START:
+                model.got_seed_start(_id)
+            elif _type == NOTIFY_SEED_END:
+                model.got_seed_end(_id)
+            elif _type == NOTIFY_CYCLE_START:
+                model.got_cycle_start(_id)
+            elif _type == NOTIFY_CYCLE_END:
+                model.got_cycle_end(_id)
@@ -10,6 +10,11 @@ for mutation in ms:
     # Do something with mutation object
 '''
 
+import numpy as np
+
+# needs to match MAX_MUTATION_PARAMS in afl-fuzz.c
+MAX_MUTATION_PARAMS = 8
+
 
 class Mutation:
 
@@ -228,3 +233,33 @@ class MutationSequence:
 
     def __iter__(self):
         return iter(self.sequence)
+
+
+# width in bytes of the region each fixed length mutation
+# starts at its position, 0 for mutations that change the length
+MUTATION_WIDTHS = np.zeros(Mutation.END_OF_SEQUENCE + 1, dtype=np.intp)
+MUTATION_WIDTHS[[0, 1, 4, 5, 10]] = 1
+MUTATION_WIDTHS[[2, 6, 7]] = 2
+MUTATION_WIDTHS[[3, 8, 9]] = 4
+
+# mutation types that change the buffer's length, after which the positions
+# of later mutations no longer line up with the seed
+RESIZING_MUTATIONS = np.zeros(Mutation.END_OF_SEQUENCE + 1, dtype=bool)
+RESIZING_MUTATIONS[[11, 12, 13, 16]] = True
+
+_ROW_SIZE = 4 * MAX_MUTATION_PARAMS
+_END_ROW = np.full(MAX_MUTATION_PARAMS, Mutation.END_OF_SEQUENCE, dtype=np.int32).tobytes()
+
+
+def used_mutations(serialized_mutations):
+    '''
+    The rows of the raw sequence afl passes to the post fuzz
+    callback that hold applied mutations, as bytes.  Unused
+    rows are all END_OF_SEQUENCE.
+    '''
+    end = serialized_mutations.find(_END_ROW)
+    if end < 0:
+        return serialized_mutations
+    # the match can start inside the last used row
+    return serialized_mutations[:-(-end // _ROW_SIZE) * _ROW_SIZE]
+
@@ -0,0 +1,99 @@
+try:
+    import _afl # built into afl-fuzz
+    import afl
+except ImportError:
+    # not embedded in afl-fuzz, e.g. replaying a recording
+    afl = None
+import os
+import signal
+import time
+
+from collections import Counter
+
+# default time between samples (seconds of CPU time)
+SAMPLE_INTERVAL = 0.005
+
+class SamplingProfiler(object):
+    """Statistical profiler for the embedded model.
+
+    A SIGPROF timer fires every interval seconds of CPU time and its handler
+    counts the Python stack it interrupted.  Inside afl-fuzz, afl drops the
+    signals that arrive while its own C code runs (afl.profile_timer), so
+    every sample lands in the model's code, in proportion to the time spent
+    there.  This is much cheaper than cProfile, which hooks every call and
+    return.
+
+    It mirrors the subset of the cProfile.Profile API used by the models
+    (enable/disable/dump_stats), so it can be passed as their `profile`.
+    dump_stats() writes collapsed stacks ("frame;frame;frame count" per line)
+    which can be fed directly to flamegraph.pl or speedscope."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.sample_time = 0.0
+        self.started = None
+
+    def enable(self):
+        if self.started is None:
+            self.started = time.time()
+        signal.signal(signal.SIGPROF, self._sample)
+        self._set_timer(self.interval)
+
+    def disable(self):
+        self._set_timer(0)
+
+    @staticmethod
+    def _set_timer(interval):
+        if afl is not None:
+            afl.profile_timer(interval)
+        else:
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+    def _sample(self, signum, frame):
+        start = time.time()
+        if frame is not None:
+            self.stacks[self._collapse(frame)] += 1
+            self.samples += 1
+        self.sample_time += time.time() - start
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def overhead(self):
+        """Fraction of the elapsed wall time spent taking samples"""
+        if self.started is None:
+            return 0.0
+        return self.sample_time / max(time.time() - self.started, self.interval)
+
+    def dump_stats(self, fname):
+        """Write the samples collected since the last dump and reset"""
+        print ('profiler: %d samples, %.3f%% of wall time spent sampling' % (self.samples, 100 * self.overhead()))
+        stacks, self.stacks = self.stacks, Counter()
+        with open(fname, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+def profiler_from_env():
+    """Build the profiler selected by $WAFL_PROFILE ("sample" or "cprofile"),
+       or return None if profiling is disabled."""
+    mode = os.environ["WAFL_PROFILE"] if "WAFL_PROFILE" in os.environ else None
+    if not mode:
+        return None
+    if mode == "sample":
+        interval = float(os.environ["WAFL_PROFILE_INTERVAL"]) if "WAFL_PROFILE_INTERVAL" in os.environ else SAMPLE_INTERVAL
+        profile = SamplingProfiler(interval)
+    elif mode == "cprofile":
+        import cProfile
+        profile = cProfile.Profile()
+    else:
+        raise ValueError("unknown WAFL_PROFILE mode %r" % mode)
+    profile.enable()
+    return profile
@@ -0,0 +1,160 @@
+import numpy as np
+import os
+
+from collections import OrderedDict
+
+class SeedCache(object):
+    """LRU cache of per-seed model state with spill-to-disk.
+
+    Each seed owns a record of numpy arrays (e.g. its bytes, weights and
+    coverage).  Records are kept in RAM until the total size exceeds the
+    memory budget, at which point the least recently used records are written
+    to spill_dir and dropped.  Spilled records are transparently reloaded on
+    the next access.  Binary (0/1) uint8 arrays listed in `packed` are stored
+    bit-packed on disk."""
+
+    def __init__(self, budget, spill_dir=None, packed=('cov',)):
+        self.budget = budget
+        if spill_dir is None:
+            # a directory we made ourselves is ours to remove on exit
+            import atexit, shutil, tempfile
+            spill_dir = tempfile.mkdtemp(prefix='wafl-spill-')
+            atexit.register(shutil.rmtree, spill_dir, True)
+        self.spill_dir = spill_dir
+        try: os.makedirs(self.spill_dir)
+        except OSError: pass
+        self.packed = set(packed)
+        self.resident = OrderedDict() # structure will be {seed_id: {field: np.array}}
+        self.spilled = set()
+        self.nbytes = 0
+        self.pinned = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetches = 0
+
+    def __contains__(self, seed_id):
+        return seed_id in self.resident or seed_id in self.spilled
+
+    def view(self, field):
+        """Return a dict-like view of a single field of every record"""
+        return _FieldView(self, field)
+
+    def get(self, seed_id, field):
+        return self._record(seed_id)[field]
+
+    def set(self, seed_id, field, value):
+        if seed_id in self:
+            record = self._record(seed_id)
+        else:
+            record = self.resident[seed_id] = {}
+        old = record.get(field)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        record[field] = value
+        self.nbytes += value.nbytes
+        self._evict()
+
+    def pin(self, seed_id):
+        """Load seed_id and keep it resident until another seed is pinned.
+
+        Hits and misses are counted here, once per visit of a seed, rather
+        than on every field access made while fuzzing it."""
+        self.pinned = seed_id
+        if seed_id in self.resident:
+            self.hits += 1
+        elif seed_id in self.spilled:
+            self.misses += 1
+        else:
+            return
+        self._record(seed_id)
+
+    def prefetch(self, seed_id):
+        """Ask the kernel to start reading a spilled record in the background"""
+        if seed_id not in self.spilled or not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            fd = os.open(self._path(seed_id), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            self.prefetches += 1
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    prefetches=self.prefetches, resident=len(self.resident),
+                    spilled=len(self.spilled), nbytes=self.nbytes)
+
+    def _path(self, seed_id):
+        return os.path.join(self.spill_dir, '%d.npz' % seed_id)
+
+    def _record(self, seed_id):
+        record = self.resident.get(seed_id)
+        if record is not None:
+            # re-insert to mark it most recently used (no move_to_end on py2)
+            self.resident[seed_id] = self.resident.pop(seed_id)
+            return record
+        if seed_id not in self.spilled:
+            raise KeyError(seed_id)
+        record = self._load(seed_id)
+        self.resident[seed_id] = record
+        self.nbytes += sum(v.nbytes for v in record.values())
+        self._evict()
+        return record
+
+    def _evict(self):
+        if not self.resident: return
+        # never evict the most recently used or the pinned record
+        mru = next(reversed(self.resident))
+        while self.nbytes > self.budget:
+            seed_id = next((k for k in self.resident if k != mru and k != self.pinned), None)
+            if seed_id is None: break
+            record = self.resident.pop(seed_id)
+            self.nbytes -= sum(v.nbytes for v in record.values())
+            self._store(seed_id, record)
+            self.evictions += 1
+
+    def _store(self, seed_id, record):
+        arrays = {}
+        for field, value in record.items():
+            if field in self.packed:
+                arrays[field] = np.packbits(value)
+                arrays[field + '_len'] = np.array(len(value))
+            else:
+                arrays[field] = value
+        with open(self._path(seed_id), 'wb') as f:
+            np.savez(f, **arrays)
+        self.spilled.add(seed_id)
+
+    def _load(self, seed_id):
+        record = {}
+        with np.load(self._path(seed_id)) as arrays:
+            for field in arrays.files:
+                if field.endswith('_len'):
+                    continue
+                value = arrays[field]
+                if field in self.packed:
+                    value = np.unpackbits(value)[:int(arrays[field + '_len'])]
+                record[field] = value
+        self.spilled.discard(seed_id)
+        os.remove(self._path(seed_id))
+        return record
+
+class _FieldView(object):
+    """dict-like access to a single field of the records in a SeedCache"""
+
+    def __init__(self, cache, field):
+        self.cache = cache
+        self.field = field
+
+    def __contains__(self, seed_id):
+        return seed_id in self.cache
+
+    def __getitem__(self, seed_id):
+        return self.cache.get(seed_id, self.field)
+
+    def __setitem__(self, seed_id, value):
+        self.cache.set(seed_id, self.field, value)
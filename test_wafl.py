@@ -0,0 +1,130 @@
+import unittest
+
+import numpy as np
+
+from wafl import WAflModel, normalized_entropy, SeedScore, VisitStats, COV_INCREASE, COV_NO_CHANGE
+from wafl_simple import WAflSimple, SimpleScheme, RewardScheme
+from wafl_interface import CovChange
+from seed_cache import SeedCache
+
+class NormalizedEntropyTest(unittest.TestCase):
+
+    def test_uniform(self):
+        self.assertAlmostEqual(normalized_entropy(np.full(16, 1.0 / 16)), 1.0)
+
+    def test_all_zero_is_uniform(self):
+        # afl builds a uniform alias table for all-zero weights
+        self.assertEqual(normalized_entropy(np.zeros(16)), 1.0)
+
+    def test_single_nonzero(self):
+        w = np.zeros(16)
+        w[3] = 1.0
+        self.assertEqual(normalized_entropy(w), 0.0)
+
+class BatchUpdateTest(unittest.TestCase):
+    """update_weights_batch must learn what update_weights does, one
+    training vector at a time"""
+
+    def check(self, scheme, cov_ids, orig_cov):
+        rng = np.random.RandomState(0)
+        seed = rng.randint(0, 256, 64).astype(np.uint8)
+        bufs = np.tile(seed, (256, 1))
+        # few changed offsets, so each changes many times in the batch
+        for row in bufs:
+            row[rng.randint(0, 8, 3)] ^= 0xff
+        scales = rng.uniform(0.5, 2.0, len(bufs))
+        sequential = scheme.initial_weights(seed.tobytes(), None)
+        batch = sequential.copy()
+        for buf, cov_id, scale in zip(bufs, cov_ids, scales):
+            scheme.update_weights(sequential, seed.tobytes(), orig_cov, buf.tobytes(), cov_id, scale)
+        scheme.update_weights_batch(batch, seed.tobytes(), orig_cov, bufs, cov_ids, scales)
+        np.testing.assert_allclose(batch, sequential)
+        return sequential
+
+    def test_simple(self):
+        # penalties, then fewer rewards: sequentially the floor clip absorbs
+        # the penalties, so the rewards still count
+        cov_ids = np.where(np.arange(256) >= 192, 7, 0)
+        w = self.check(SimpleScheme(max_weight=4), cov_ids, 0)
+        self.assertGreater(w.max(), 1)
+
+    def test_reward(self):
+        cov_ids = np.random.RandomState(1).randint(COV_NO_CHANGE, COV_INCREASE + 4, 256)
+        self.check(RewardScheme(), cov_ids, 0)
+
+class SeedScoreTest(unittest.TestCase):
+
+    @staticmethod
+    def mult(weights):
+        visit = VisitStats()
+        for code in [COV_INCREASE] * 4 + [COV_NO_CHANGE] * 1000:
+            visit.witness(code)
+        visit.entropy = normalized_entropy(weights)
+        scoring = SeedScore()
+        scoring.end(0, visit)
+        return scoring.score(0)
+
+    def test_all_zero_scores_as_uniform(self):
+        self.assertEqual(self.mult(np.zeros(16)), self.mult(np.ones(16)))
+
+    def test_concentrated_scores_higher(self):
+        w = np.zeros(16)
+        w[3] = 1.0
+        self.assertGreater(self.mult(w), self.mult(np.ones(16)))
+
+class SeedCacheTest(unittest.TestCase):
+
+    def test_hit_is_most_recently_used(self):
+        cache = SeedCache(budget=3 * 800)
+        weights = cache.view('weights')
+        for seed_id in range(3):
+            weights[seed_id] = np.zeros(100)
+        weights[0]
+        # over budget: 1 is now the least recently used, not 0
+        weights[3] = np.zeros(100)
+        self.assertEqual(cache.spilled, set([1]))
+        np.testing.assert_array_equal(weights[1], np.zeros(100))
+
+class OfflineModel(WAflModel):
+    """WAflModel that keeps its weights to itself instead of writing them to afl"""
+
+    def save_weights(self, seed_id, weights_norm, wide_norms=()):
+        pass
+
+class OfflineSimple(WAflSimple):
+
+    def save_weights(self, seed_id, weights, wide_weights=()):
+        pass
+
+class TrimTest(unittest.TestCase):
+    """Weights trained before a trim must survive it"""
+
+    def train_and_trim(self, model, weights):
+        seed = bytes(bytearray(range(32)))
+        model.got_new_seed(0, seed, None)
+        model.got_seed_start(0)
+        rng = np.random.RandomState(0)
+        for i in range(64):
+            buf = bytearray(seed)
+            for offset in rng.randint(0, len(seed), 2):
+                buf[offset] ^= 0xff
+            code = COV_INCREASE if i % 2 else COV_NO_CHANGE
+            model.got_training(0, bytes(buf), None, None, None, 0, i % 2, CovChange(code, i % 2, 0, b''))
+        model.got_seed_end(0)
+        trained = weights()[0].copy()
+        self.assertFalse(np.all(trained == trained[0]))
+        # cut bytes 4..9 and 20
+        removed = np.array([[4, 6], [20, 1]])
+        model.got_trimmed_seed(0, seed[:4] + seed[10:20] + seed[21:], None, removed)
+        np.testing.assert_array_equal(weights()[0], np.delete(trained, list(range(4, 10)) + [20]))
+
+    def test_model(self):
+        model = OfflineModel()
+        self.train_and_trim(model, lambda: model.weight_table)
+
+    def test_simple(self):
+        model = OfflineSimple()
+        self.train_and_trim(model, lambda: model.weights)
+
+if __name__ == '__main__':
+    unittest.main()
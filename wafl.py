@@ -1,21 +1,24 @@
 import numpy as np
 import os
-from wafl_interface import WAflInterface
+from wafl_interface import WAflInterface, kept_offsets
+from wafl_simple import RewardScheme, get_scheme, check_scheme, COV_IDS_CLASS
+from wafl_simple import COV_NO_CHANGE, COV_CHANGE, COV_INCREASE, COV_SOFT_INCREASE, COV_SOFT_DECREASE, COV_DECREASE
+from seed_cache import SeedCache
+from mutation_sequence import MAX_MUTATION_PARAMS, MUTATION_WIDTHS, RESIZING_MUTATIONS, used_mutations
+from alias_table import ALIAS_WIDTHS
 from util import fast_hash
-import json
-import shutil
 
 from collections import Counter,defaultdict
 
 COV_MAX_SIZE = 65536
 
-# CONSTANTS to depict change in coverage
-COV_NO_CHANGE = -1
-COV_CHANGE = 0
-COV_INCREASE = 1
-COV_SOFT_INCREASE = 2
-COV_SOFT_DECREASE = 3
-COV_DECREASE = 4
+# flags got_seed_start can return, these need to match SEED_* in afl's
+# pycallback.h
+SEED_UNIFORM = 1
+
+# mutation widths that get weights (and alias tables) of their own on top of
+# the per-byte weights
+WIDE_WIDTHS = ALIAS_WIDTHS[1:]
 
 class MultiStats():
     def __init__(self):
@@ -24,6 +27,7 @@ class MultiStats():
         self.spliced = Counter()
 
     def dump(self, fname):
+        import json
         for attr in vars(self):
             with open("{}_{}".format(fname,attr), 'wb') as f:
                 json.dump(getattr(self,attr), f)
@@ -37,19 +41,320 @@ class MultiStats():
     def witness_cov_change(self, change_type):
         self.cov_change[change_type] +=1
 
+class EdgeRarity(object):
+    """Global, decayed count of how often each edge of the coverage map has
+    changed relative to the parent seed.  Edges that change all the time are
+    common; edges that rarely change are rare and worth more.
+
+    Counts are only touched for the edges of the current exec.  Decay is kept
+    O(1) by stamping each count with the epoch it was last updated in and
+    applying decay**(epochs since) lazily when the edge is next touched."""
+
+    def __init__(self, decay=0.9, size=COV_MAX_SIZE):
+        self.decay = decay
+        self.counts = np.zeros(size, dtype=np.float64)
+        self.stamps = np.zeros(size, dtype=np.int64)
+        self.epoch = 0
+
+    def next_epoch(self):
+        self.epoch += 1
+
+    def rarity(self, edges):
+        """
+        Return the mean rarity of edges, 1.0 for edges never seen changing
+        down towards 0 for very common ones, then count them.
+
+        :param edges: np.array of unique edge indices, afl's sample of up to
+                      COV_MAX_EDGES of them for large changes
+        :return: float
+        """
+        if not len(edges):
+            return 1.0
+        counts = self.counts[edges] * self.decay ** (self.epoch - self.stamps[edges])
+        rarity = np.mean(1.0 / np.sqrt(1.0 + counts))
+        self.counts[edges] = counts + 1
+        self.stamps[edges] = self.epoch
+        return rarity
+
+class WeightDecay(object):
+    """Forgets old training by scaling every seed's weights by decay once per
+    queue cycle.
+
+    Nothing is done per cycle.  Each seed is stamped with the epoch its
+    weights were last brought up to date in, and the accumulated factor
+    decay**(epochs since) is folded into its weights when the seed is next
+    touched (fuzzed or trimmed), so seeds that afl keeps skipping cost
+    nothing.  Folding the factor in at every touch keeps the weights from
+    drifting towards underflow; a seed idle for so long that its factor
+    drops below forget_below simply starts over.  How the factor is applied
+    is up to the scheme (decay_weights): scaling float weights, as the reward
+    scheme does, doesn't change the normalized distribution, only how much
+    past training counts against new training, while integer schemes move
+    their weights back towards the initial weight."""
+
+    def __init__(self, decay=0.5, forget_below=1e-12):
+        self.decay = decay
+        self.forget_below = forget_below
+        self.stamps = {}
+        self.epoch = 0
+
+    def next_epoch(self):
+        self.epoch += 1
+
+    def reset(self, seed_id):
+        """seed_id's weights are up to date, e.g. because they are new"""
+        self.stamps[seed_id] = self.epoch
+
+    def factor(self, seed_id):
+        """Return the decay seed_id's weights have accumulated since they
+        were last brought up to date and mark them up to date"""
+        elapsed = self.epoch - self.stamps.get(seed_id, self.epoch)
+        self.stamps[seed_id] = self.epoch
+        return self.decay ** elapsed
+
+class SeedConvergence(object):
+    """Decides when training a seed no longer pays for itself.
+
+    At the end of every visit the seed's published distribution is checked:
+    if its normalized entropy is at least entropy it is as good as uniform
+    (converged), and if fewer than min_yield of the visit's execs (at least
+    min_execs of them) produced COV_INCREASE it is unproductive.  Either way
+    the seed is paused for the next probe_every - 1 visits, during which afl
+    samples it uniformly and sends no training, and is then trained for one
+    visit again to re-check."""
+
+    def __init__(self, entropy=0.98, min_yield=1e-4, min_execs=1024, probe_every=8):
+        self.entropy = entropy
+        self.min_yield = min_yield
+        self.min_execs = min_execs
+        self.probe_every = probe_every
+        self.paused = {} # structure will be {seed_id: visits left}
+
+    def start(self, seed_id):
+        """Return True if seed_id is paused for this visit"""
+        left = self.paused.pop(seed_id, 0)
+        if left > 1:
+            self.paused[seed_id] = left - 1
+            return True
+        return False
+
+    def end(self, seed_id, visit):
+        """Pause seed_id if the visit that just ended (a VisitStats) shows it
+        has converged or stopped producing, and return whether it was paused"""
+        unproductive = visit.execs >= self.min_execs and visit.increases < self.min_yield * visit.execs
+        if unproductive or visit.entropy >= self.entropy:
+            self.paused[seed_id] = self.probe_every
+            return True
+        return False
+
+class SeedScore(object):
+    """Per-seed multiplier of afl's perf score, shifting havoc time towards
+    seeds whose learned offsets keep finding new coverage.
+
+    At the end of every trained visit a seed's COV_INCREASE yield is compared
+    to the running mean yield of all seeds (smoothed by prior execs worth of
+    the mean, so short visits stay close to 1) and doubled at most for a
+    fully concentrated distribution.  The result, clipped to [min_mult,
+    max_mult], is cached so afl's query is a dict lookup.  A seed that went
+    skip_after visits in a row without an increase is skipped for its next
+    visit, then tried again."""
+
+    def __init__(self, min_mult=0.25, max_mult=4.0, prior=256, mean_decay=0.9, skip_after=None):
+        self.min_mult = min_mult
+        self.max_mult = max_mult
+        self.prior = prior
+        self.mean_decay = mean_decay
+        self.skip_after = skip_after
+        self.mean_yield = None
+        self.mults = {} # structure will be {seed_id: multiplier}
+        self.dry = {} # structure will be {seed_id: visits in a row without an increase}
+        self.skipped = set()
+
+    def score(self, seed_id):
+        """Return seed_id's multiplier, None if it hasn't got one yet or 0 to
+        skip it this time"""
+        if seed_id in self.skipped:
+            self.skipped.discard(seed_id)
+        elif self.skip_after and self.dry.get(seed_id, 0) >= self.skip_after:
+            self.skipped.add(seed_id)
+            return 0
+        return self.mults.get(seed_id)
+
+    def end(self, seed_id, visit):
+        if not visit.execs:
+            return
+        visit_yield = float(visit.increases) / visit.execs
+        if self.mean_yield is None:
+            self.mean_yield = visit_yield
+        else:
+            self.mean_yield = self.mean_decay * self.mean_yield + (1 - self.mean_decay) * visit_yield
+        relative = (visit.increases + self.prior * self.mean_yield) / ((visit.execs + self.prior) * self.mean_yield) if self.mean_yield else 1.0
+        # all-zero weights have entropy 1.0 too: afl samples them uniformly
+        mult = relative * (2.0 - min(max(visit.entropy, 0.0), 1.0))
+        self.mults[seed_id] = min(max(mult, self.min_mult), self.max_mult)
+        self.dry[seed_id] = 0 if visit.increases else self.dry.get(seed_id, 0) + 1
+
+class VisitStats(object):
+    """What the model saw while afl fuzzed the current seed"""
+
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        self.execs = 0
+        self.increases = 0
+        self.entropy = None
+
+    def witness(self, code):
+        self.execs += 1
+        if code == COV_INCREASE:
+            self.increases += 1
+
+def normalized_entropy(weights):
+    """Entropy of weights as a distribution, 1.0 for uniform.  All-zero
+    weights count as uniform, as that is how afl samples them."""
+    if len(weights) < 2 or weights.sum() <= 0:
+        return 1.0
+    p = weights[weights > 0]
+    p = p / p.sum()
+    return -np.dot(p, np.log(p)) / np.log(len(weights))
+
+class TrainingBuffer(object):
+    """Growable buffer of (changed offset, COV_* code, reward scale) for one seed.
+
+    Appending an exec's changed offsets is cheap; the buffer is reduced into
+    the seed's weights in a single vectorized pass by flush()."""
+
+    def __init__(self, capacity=1<<16):
+        self.offsets = np.empty(capacity, dtype=np.intp)
+        self.codes = np.empty(capacity, dtype=np.intp)
+        self.scales = np.empty(capacity, dtype=np.float64)
+        self.size = 0
+        self.seed_id = None
+
+    def append(self, offsets, code, scale=1.0):
+        end = self.size + len(offsets)
+        if end > len(self.offsets):
+            capacity = max(end, 2*len(self.offsets))
+            self.offsets = np.resize(self.offsets, capacity)
+            self.codes = np.resize(self.codes, capacity)
+            self.scales = np.resize(self.scales, capacity)
+        self.offsets[self.size:end] = offsets
+        self.codes[self.size:end] = code
+        self.scales[self.size:end] = scale
+        self.size = end
+
+    def flush(self, scheme, w):
+        """Apply the buffered training to w and empty the buffer"""
+        if self.size:
+            scheme.update_weights_sparse(w, COV_NO_CHANGE, self.offsets[:self.size], self.codes[:self.size], self.scales[:self.size])
+        self.size = 0
+
+class MutationTrainingBuffer(object):
+    """Buffer of raw mutation sequences with their COV_* code and reward
+    scale, for training the word/dword weights of one seed.
+
+    Decoding a sequence costs several numpy calls, which adds up when done
+    for every exec, so only the used rows of each sequence are kept and they
+    are decoded in a single vectorized pass by flush().  The weights are only
+    read when the seed's alias tables are written, so batching does not change
+    what afl sees.  Execs that changed the buffer's length along the way are
+    left out, their positions don't refer to the seed's bytes.  The buffer is
+    full once it holds max_rows mutations."""
+
+    def __init__(self, max_rows=1<<16):
+        self.max_rows = max_rows
+        self.clear()
+        self.seed_id = None
+
+    def clear(self):
+        self.seqs = []
+        self.codes = []
+        self.scales = []
+        self.counts = []
+        self.rows = 0
+
+    def full(self):
+        return self.rows >= self.max_rows
+
+    def append(self, mutation_seq, code, scale=1.0):
+        used = used_mutations(mutation_seq)
+        count = len(used) // (4 * MAX_MUTATION_PARAMS)
+        self.seqs.append(used)
+        self.codes.append(code)
+        self.scales.append(scale)
+        self.counts.append(count)
+        self.rows += count
+
+    def flush(self, scheme, tables):
+        """Apply the buffered training to tables ({width: weights}) and empty
+        the buffer"""
+        if self.seqs:
+            rows = np.frombuffer(b''.join(self.seqs), dtype=np.int32).reshape(-1, MAX_MUTATION_PARAMS)
+            execs = np.repeat(np.arange(len(self.seqs)), self.counts)
+            codes = np.asarray(self.codes)
+            scales = np.asarray(self.scales)
+            mutation_widths = MUTATION_WIDTHS[rows[:, 0]]
+            resized = np.zeros(len(self.seqs), dtype=bool)
+            resized[execs[RESIZING_MUTATIONS[rows[:, 0]]]] = True
+            usable = ~resized[execs]
+            for width, w in tables.items():
+                sel = usable & (mutation_widths == width) & (rows[:, 1] < len(w))
+                # count an offset once per exec, like the per-byte weights
+                keys = np.unique(execs[sel] * len(w) + rows[sel, 1])
+                e, offsets = np.divmod(keys, len(w))
+                scheme.update_weights_sparse(w, COV_NO_CHANGE, offsets, codes[e], scales[e])
+        self.clear()
+
 class WAflModel(WAflInterface):
 
-    def __init__(self, save_incremental_dir=None, stats=None, alpha = 0.5,beta=0.4, gamma=0.3, delta=0.2, epsilon=0.1, profile=None):
+    def __init__(self, save_incremental_dir=None, stats=None, alpha = 0.5,beta=0.4, gamma=0.3, delta=0.2, epsilon=0.1, profile=None, scheme=None, cache_budget=None, spill_dir=None, afl_cov_class=True, defer_training=False, rarity_decay=None, wide_tables=True, weight_decay=None, convergence=None, scoring=None):
         """
         Seeds is a list of buffers, optional
 
-        """
+        If afl_cov_class is set, use the coverage change class computed by afl
+        instead of comparing full coverage maps in python.
+
+        If defer_training is set, training for a seed is buffered and only
+        applied to its weights once, at the end of the seed.
+
+        If rarity_decay is set, rewards are scaled by how rarely the edges that
+        changed have changed before, with counts decaying by rarity_decay per
+        seed fuzzed.
 
-        super(WAflModel, self).__init__()
+        If wide_tables is set, word and dword mutations get weights of their
+        own, trained from the mutation sequences, so afl can sample their
+        offsets directly.
 
-        self.seed_table = {} # structure will be {seed_id: bytes}#
-        self.weight_table = {} # structure will be {seed_id: np.zeros(len(seed), dtype=np.float64)
-        self.latest_cov = {} # structure will be {seed_id: np.zeros(COV_MAX_SIZE), dtype=uint32}
+        If weight_decay is set, past training is scaled down by weight_decay
+        every queue cycle (see WeightDecay).
+
+        If convergence is set (a SeedConvergence), seeds whose weights have
+        converged to near uniform or that stopped finding new coverage are
+        sampled uniformly by afl, without training, until they are re-probed.
+
+        If scoring is set (a SeedScore), afl's perf score of each seed is
+        scaled by how well its training has been paying off.
+        """
+
+        super(WAflModel, self).__init__(want_coverage=not afl_cov_class or stats is not None)
+        self.afl_cov_class = afl_cov_class
+
+        if cache_budget:
+            # keep the per-seed state in an LRU cache that spills cold seeds
+            # to disk once cache_budget bytes are in use
+            self.cache = SeedCache(cache_budget, spill_dir)
+            self.seed_table = self.cache.view('seed')
+            self.weight_table = self.cache.view('weights')
+            self.latest_cov = self.cache.view('cov')
+            self.wide_weight_table = dict((w, self.cache.view('weights%d' % w)) for w in WIDE_WIDTHS) if wide_tables else {}
+        else:
+            self.cache = None
+            self.seed_table = {} # structure will be {seed_id: bytes}#
+            self.weight_table = {} # structure will be {seed_id: np.zeros(len(seed), dtype=np.float64)
+            self.latest_cov = {} # structure will be {seed_id: np.zeros(COV_MAX_SIZE), dtype=uint32}
+            # structure will be {width: {seed_id: np.zeros(len(seed) - width + 1, dtype=np.float64)}}
+            self.wide_weight_table = dict((w, {}) for w in WIDE_WIDTHS) if wide_tables else {}
         self.cov_counter = {}
 
         # Save off params for rewarding/penalizing training
@@ -58,6 +363,19 @@ class WAflModel(WAflInterface):
         self.gamma = gamma
         self.delta = delta
         self.epsilon = epsilon
+        if scheme is None:
+            scheme = RewardScheme(alpha=alpha, beta=beta, gamma=gamma, delta=delta, epsilon=epsilon)
+        # coverage ids are COV_* codes, from afl or calc_cov_change
+        check_scheme(scheme, COV_IDS_CLASS)
+        self.scheme = scheme
+        self.training = TrainingBuffer() if defer_training else None
+        self.wide_training = MutationTrainingBuffer() if wide_tables else None
+        self.rarity = EdgeRarity(rarity_decay) if rarity_decay else None
+        self.decay = WeightDecay(weight_decay) if weight_decay else None
+        self.convergence = convergence
+        self.scoring = scoring
+        self.uniform_seed = None
+        self.visit = VisitStats()
 
         # other
         self.profile = profile
@@ -86,9 +404,21 @@ class WAflModel(WAflInterface):
             print ("updating existing seed (id=%d, len=%d)." % (seed_id, len(buf)))
         else:
             print ("got new seed (id=%d, len=%d)." % (seed_id, len(buf)))
+        if self.training is not None and self.training.seed_id == seed_id:
+            self.training.size = 0
+            self.training.seed_id = None
+        if self.wide_training is not None and self.wide_training.seed_id == seed_id:
+            self.wide_training.clear()
+            self.wide_training.seed_id = None
         self.seed_table[seed_id] = np.frombuffer(buf, dtype=np.uint8)
-        self.weight_table[seed_id] = np.zeros(len(buf), dtype=np.float64)
-        self.latest_cov[seed_id] = self.binarize_cov(cov)
+        self.weight_table[seed_id] = self.scheme.initial_weights(buf, cov)
+        for width, table in self.wide_weight_table.items():
+            # one weight per offset a mutation of this width can start at
+            table[seed_id] = self.scheme.initial_weights(buf[width - 1:], cov)
+        if self.decay is not None:
+            self.decay.reset(seed_id)
+        if not self.afl_cov_class:
+            self.latest_cov[seed_id] = self.binarize_cov(cov)
         # with np.printoptions(threshold=np.inf, suppress=True):
         #     print('cov nonzero at:')
         #     print(np.where(self.latest_cov[seed_id]))
@@ -96,6 +426,41 @@ class WAflModel(WAflInterface):
         #     print(np.where(self.seed_table[seed_id]))
 
 
+    def got_trimmed_seed(self, seed_id, buf, cov, removed):
+        """
+        afl trimmed a seed.  Keep what was learned for the bytes that survived
+        instead of starting over, and publish the weights right away so the
+        seed's upcoming havoc stage uses them.  afl trims a seed at the start
+        of its first visit, before any training, so trained weights only go
+        through here if a seed is trimmed again after it was trained.
+
+        :param seed_id: int
+        :param buf: str, the trimmed buffer
+        :param cov: str
+        :param removed: (n, 2) array of (offset, length) ranges cut from the old buffer
+        :return:
+        """
+        if seed_id not in self.seed_table:
+            return self.got_new_seed(seed_id, buf, cov)
+        print ("trimmed seed (id=%d, len=%d -> %d)." % (seed_id, len(self.seed_table[seed_id]), len(buf)))
+        # pending training refers to the old buffer
+        self.flush_training()
+        self.flush_wide_training()
+        self.apply_decay(seed_id)
+        kept = kept_offsets(len(self.seed_table[seed_id]), removed)
+        self.seed_table[seed_id] = np.frombuffer(buf, dtype=np.uint8)
+        self.weight_table[seed_id] = self.weight_table[seed_id][kept]
+        for width, table in self.wide_weight_table.items():
+            # a wide offset survives if the whole region it starts was kept in one piece
+            weights = self.scheme.initial_weights(buf[width - 1:], cov)
+            starts = kept[:len(weights)]
+            intact = kept[width - 1:] - starts == width - 1
+            weights[intact] = table[seed_id][starts[intact]]
+            table[seed_id] = weights
+        if not self.afl_cov_class:
+            self.latest_cov[seed_id] = self.binarize_cov(cov)
+        self.write_weights(seed_id)
+
     def get_weights(self, seed_id):
         """
         Given a x from AFL, calculate the weight vector of each byte.
@@ -202,51 +567,52 @@ class WAflModel(WAflInterface):
         return cov_return
 
 
-    def got_training(self, seed_id, new_bytes, cov_new, mutation_seq, splicing_with, old_cksum, new_cksum):
+    def got_training(self, seed_id, new_bytes, cov_new, mutation_seq, splicing_with, old_cksum, new_cksum, cov_change=None):
         """
         Given a buffer and edge coverage from AFL, update the seed_id's weights
 
         :param seed_id: ancestor seed that new_bytes came from
         :param new_bytes: byte buffer of mutated buffer
         :param cov_new: edge coverage of new_bytes
+        :param cov_change: coverage change class computed by afl
         :return:
         """
+        if seed_id == self.uniform_seed:
+            # afl doesn't send these, but a replay might
+            return
         # Get seed bytes
         seed_bytes = self.seed_table[seed_id]
         # TODO: Only calculate change if one ancestor. Handle this if too many instances where >1 ancestor
         # TODO: cannot handle different length seed and new bytes
         if splicing_with is None and len(seed_bytes) == len(new_bytes):
-            new_bytes = np.frombuffer(new_bytes, dtype=np.uint8)
-            # calculate bytes_changed from new_bytes
-            bytes_changed = self.calc_bytes_changed(seed_id, new_bytes)
-
-            cov_change = self.calc_cov_change(seed_id, cov_new, old_cksum, new_cksum)
-            # print('cov_change:', cov_change)
-            # print(np.where(cov_new))
-            # print(np.where(bytes_changed))
-            # if edge coverage increases
-            if cov_change == COV_INCREASE:
-                self.weight_table[seed_id] = self.weight_table[seed_id] + bytes_changed  # NUMBER 1 REWARD
-
-            if cov_change == COV_SOFT_INCREASE:
-                self.weight_table[seed_id] = self.weight_table[seed_id] + self.alpha*bytes_changed  # NUMBER 2 REWARD
-
-            # if edge coverage changes, but didn't strictly increase
-            if cov_change == COV_CHANGE:
-                self.weight_table[seed_id] = self.weight_table[seed_id] + self.beta*bytes_changed # NUMBER 3 REWARD
-
-            # if edge coverage changes, increases in some spots, but decreases overall
-            if cov_change == COV_SOFT_DECREASE:
-                self.weight_table[seed_id] = self.weight_table[seed_id] + self.gamma*bytes_changed # NUMBER 4 REWARD
-
-            # if edge coverage changes, but decreases overall
-            if cov_change == COV_DECREASE:
-                self.weight_table[seed_id] = self.weight_table[seed_id] - self.delta * bytes_changed  # PENALTY
-
-            # if edge coverage doesn't change, penalize here?
-            # this is terrible outcome, says danny.
-            if cov_change == COV_NO_CHANGE:
-                self.weight_table[seed_id] = self.weight_table[seed_id] - self.epsilon*bytes_changed # PENALTY
+            afl_change = cov_change
+            if self.afl_cov_class:
+                cov_change = cov_change.code
+                if self.stats is not None:
+                    self.stats.witness_cov_change(cov_change)
+            else:
+                cov_change = self.calc_cov_change(seed_id, cov_new, old_cksum, new_cksum)
+            self.visit.witness(cov_change)
+            scale = 1.0
+            if self.rarity is not None:
+                scale = self.rarity.rarity(self.changed_edges(seed_id, cov_new, afl_change))
+            if self.training is not None:
+                # defer the update to got_seed_end
+                if self.training.seed_id != seed_id:
+                    self.flush_training()
+                    self.training.seed_id = seed_id
+                changed = np.flatnonzero(seed_bytes != np.frombuffer(new_bytes, dtype=np.uint8))
+                self.training.append(changed, cov_change, scale)
+            else:
+                # reward/penalize the changed bytes according to the scheme; the
+                # seed's own coverage is identified as COV_NO_CHANGE
+                self.scheme.update_weights(self.weight_table[seed_id], seed_bytes, COV_NO_CHANGE, new_bytes, cov_change, scale)
+            if self.wide_training is not None and mutation_seq is not None:
+                # word/dword weights are always trained in batches
+                if self.wide_training.seed_id != seed_id or self.wide_training.full():
+                    self.flush_wide_training()
+                    self.wide_training.seed_id = seed_id
+                self.wide_training.append(mutation_seq, cov_change, scale)
 
             return cov_change
 
@@ -255,27 +621,79 @@ class WAflModel(WAflInterface):
        #     self.stats.dump(os.path.join(self.save_incremental_dir, 'testsave.stats'))
 
 
+    def changed_edges(self, seed_id, cov_new, afl_change):
+        """
+        Indices of the edges whose coverage differs from the seed's, from afl
+        if it classified the change, otherwise from the full coverage maps.
+        """
+        if self.afl_cov_class:
+            return np.frombuffer(afl_change.edges, dtype=np.uint32)
+        return np.flatnonzero(self.binarize_cov(cov_new) != self.latest_cov[seed_id])
+
     def normalize_weights(self, weights):
-        weights_sum = np.sum(weights)
-        if weights_sum == 0:
-            norm = weights
-        else:
-            norm = weights/weights_sum
-        if norm.dtype != np.float64:
-            return np.array(norm, dtype=np.float64)
-        else:
-            return norm
+        return self.scheme.normalize_weights(weights)
+
+    def flush_training(self):
+        """Apply any deferred training to the weights of its seed"""
+        if self.training is not None and self.training.seed_id is not None:
+            self.training.flush(self.scheme, self.weight_table[self.training.seed_id])
+            self.training.seed_id = None
+
+    def flush_wide_training(self):
+        """Apply the buffered mutation sequences to the word/dword weights of their seed"""
+        if self.wide_training is not None and self.wide_training.seed_id is not None:
+            seed_id = self.wide_training.seed_id
+            self.wide_training.flush(self.scheme, dict((w, t[seed_id]) for w, t in self.wide_weight_table.items()))
+            self.wide_training.seed_id = None
 
     def got_cycle_start(self, num):
         self.curr_cycle = num
 
+    def got_seed_start(self, seed_id):
+        """
+        Make sure the seed's state is resident before training starts and
+        start reading the next queue entry's state from disk.
+
+        :param seed_id: int
+        :return: SEED_UNIFORM if the seed is paused for this visit
+        """
+        self.visit.start()
+        if self.convergence is not None and self.convergence.start(seed_id):
+            self.uniform_seed = seed_id
+            return SEED_UNIFORM
+        self.uniform_seed = None
+        if self.cache is not None:
+            self.cache.pin(seed_id)
+            self.cache.prefetch(seed_id + 1)
+        self.apply_decay(seed_id)
+
+    def apply_decay(self, seed_id):
+        """Bring seed_id's weights up to date with the decay since it was last touched"""
+        if self.decay is None:
+            return
+        factor = self.decay.factor(seed_id)
+        if factor == 1.0:
+            return
+        if factor < self.decay.forget_below:
+            seed_bytes = self.seed_table[seed_id]
+            self.weight_table[seed_id] = self.scheme.initial_weights(seed_bytes, None)
+            for width, table in self.wide_weight_table.items():
+                table[seed_id] = self.scheme.initial_weights(seed_bytes[width - 1:], None)
+            return
+        for table in [self.weight_table] + list(self.wide_weight_table.values()):
+            self.scheme.decay_weights(table[seed_id], factor)
+
     def got_cycle_end(self, num):
         """
         At the end of the cycle, write out the entire weight table
         :param num: int
         :return:
         """
+        if self.decay is not None:
+            self.decay.next_epoch()
         # Write out any stats and profile info
+        if self.cache is not None:
+            print ('seed cache: %s' % ', '.join('%s=%d' % kv for kv in sorted(self.cache.stats().items())))
         if self.stats is not None and self.save_incremental_dir:
             self.stats.dump(os.path.join(self.save_incremental_dir, 'cycle%04d.stats' % num))
         if self.profile is not None and self.save_incremental_dir:
@@ -290,16 +708,39 @@ class WAflModel(WAflInterface):
         :param seed_id: int
         :return:
         """
-        weights = self.weight_table[seed_id]
-        # normalize weights and write out to afl
-        weights_norm = self.normalize_weights(weights)
-        path = self.save_weights(seed_id, weights_norm)
+        if seed_id == self.uniform_seed:
+            # nothing was trained, afl still has the last weights written
+            self.uniform_seed = None
+            return
+        self.flush_training()
+        self.flush_wide_training()
+        if self.rarity is not None:
+            self.rarity.next_epoch()
+        weights_norm = self.write_weights(seed_id)
+        if self.convergence is not None or self.scoring is not None:
+            self.visit.entropy = normalized_entropy(weights_norm)
+        if self.scoring is not None:
+            self.scoring.end(seed_id, self.visit)
+        if self.convergence is not None and self.convergence.end(seed_id, self.visit):
+            print ('pausing training for %d' % seed_id)
+
+    def seed_score(self, seed_id):
+        if self.scoring is not None:
+            return self.scoring.score(seed_id)
+
+    def write_weights(self, seed_id):
+        """Normalize a seed's weights, write them out to afl and return the
+        normalized byte weights"""
+        weights_norm = self.normalize_weights(self.weight_table[seed_id])
+        wide_norms = [self.normalize_weights(self.wide_weight_table[w][seed_id]) for w in sorted(self.wide_weight_table)]
+        path = self.save_weights(seed_id, weights_norm, wide_norms)
         # save debug info
         self.save_incremental(path, weights_norm)
+        return weights_norm
 
-    def save_weights(self, seed_id, weights_norm):
+    def save_weights(self, seed_id, weights_norm, wide_norms=()):
         print ('saving weights for %d (len=%d)' % (seed_id, len(weights_norm)))
-        return super(WAflModel, self).save_weights(seed_id, weights_norm)
+        return super(WAflModel, self).save_weights(seed_id, weights_norm, wide_norms)
 
     # mostly for debugging
     def save_incremental(self, alias_fname, norm):
@@ -308,6 +749,7 @@ class WAflModel(WAflInterface):
             try: os.mkdir(dest_dir)
             except OSError: pass
             # save the alias table
+            import shutil
             shutil.copy(alias_fname, dest_dir)
             # save the normalized weights
             weights_fname = '%s/%s.weights' % (dest_dir, os.path.basename(alias_fname))
@@ -338,9 +780,9 @@ class WAflModel(WAflInterface):
 
 
 if __name__ == "__main__":
-    # import cProfile
-    # profile = cProfile.Profile()
-    # profile.enable()
+    # WAFL_PROFILE=sample (statistical, low overhead) or WAFL_PROFILE=cprofile
+    from sampling_profiler import profiler_from_env
+    profile = profiler_from_env()
 
     import argparse
 
@@ -349,7 +791,19 @@ if __name__ == "__main__":
     gamma =  float(os.environ["WAFL_GAMMA"]) if "WAFL_GAMMA" in os.environ else 0.3
     delta =  float(os.environ["WAFL_DELTA"]) if "WAFL_DELTA" in os.environ else 0.2
     epsilon =  float(os.environ["WAFL_EPSILON"]) if "WAFL_EPSILON" in os.environ else 0.1
-    # savedir = os.environ["SAVE_DIR"] if "SAVE_DIR" in os.environ else None
+    scheme = os.environ["WAFL_SCHEME"] if "WAFL_SCHEME" in os.environ else "reward"
+    savedir = os.environ["SAVE_DIR"] if "SAVE_DIR" in os.environ else None
+    cache_mb = float(os.environ["WAFL_CACHE_MB"]) if "WAFL_CACHE_MB" in os.environ else None
+    spill_dir = os.environ["WAFL_SPILL_DIR"] if "WAFL_SPILL_DIR" in os.environ else None
+    defer_training = os.environ.get("WAFL_DEFER_TRAINING", "0") != "0"
+    rarity_decay = float(os.environ["WAFL_RARITY_DECAY"]) if "WAFL_RARITY_DECAY" in os.environ else None
+    wide_tables = os.environ.get("WAFL_WIDE_TABLES", "1") != "0"
+    weight_decay = float(os.environ["WAFL_WEIGHT_DECAY"]) if "WAFL_WEIGHT_DECAY" in os.environ else None
+    fallback_entropy = float(os.environ["WAFL_FALLBACK_ENTROPY"]) if "WAFL_FALLBACK_ENTROPY" in os.environ else None
+    fallback_yield = float(os.environ["WAFL_FALLBACK_YIELD"]) if "WAFL_FALLBACK_YIELD" in os.environ else None
+    fallback_probe = int(os.environ["WAFL_FALLBACK_PROBE"]) if "WAFL_FALLBACK_PROBE" in os.environ else 8
+    score = os.environ.get("WAFL_SCORE", "0") != "0"
+    score_skip = int(os.environ["WAFL_SCORE_SKIP"]) if "WAFL_SCORE_SKIP" in os.environ else None
 
     # print ("Outputing incremental save to {}".format(savedir))
     # if savedir is not None:
@@ -363,7 +817,20 @@ if __name__ == "__main__":
         gamma = gamma,
         delta = delta,
         epsilon = epsilon,
+        scheme = None if scheme == "reward" else get_scheme(scheme),
         # stats=MultiStats(),
-        # profile=profile,
-        # save_incremental_dir=savedir
+        profile=profile,
+        save_incremental_dir=savedir,
+        cache_budget = int(cache_mb * 1024 * 1024) if cache_mb else None,
+        spill_dir = spill_dir,
+        defer_training = defer_training,
+        rarity_decay = rarity_decay,
+        wide_tables = wide_tables,
+        weight_decay = weight_decay,
+        convergence = SeedConvergence(
+            entropy = fallback_entropy if fallback_entropy is not None else float('inf'),
+            min_yield = fallback_yield or 0.0,
+            probe_every = fallback_probe,
+            ) if fallback_entropy is not None or fallback_yield is not None else None,
+        scoring = SeedScore(skip_after=score_skip) if score else None,
         )
@@ -0,0 +1,214 @@
+"""
+Benchmark whole fuzzing campaigns with and without the embedded model.
+
+Runs afl-fuzz for a fixed duration with a fixed RNG seed (AFL_FIXED_SEED) for
+every configuration, repeats each run, spreads the runs over the available
+cores and reports exec/s, paths found over time and the time spent in python
+side by side, with the spread over the repeated runs:
+
+    python wafl_bench.py -d 600 -r 3 -j 8 --model mine=my_model.py -o results.json
+
+The built-in configurations are plain afl ("afl"), wafl_simple.py ("simple")
+and wafl.py ("wafl").  By default the example zlib target is fuzzed; pass a
+different target after "--".  The WAFL_* environment variables are passed
+through to the models.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name -> python file passed to afl-fuzz -P (None for plain afl)
+CONFIGS = OrderedDict([
+    ('afl', None),
+    ('simple', os.path.join(HERE, 'wafl_simple.py')),
+    ('wafl', os.path.join(HERE, 'wafl.py')),
+    ])
+
+# plot_data columns, see afl-fuzz.c
+PLOT_TIME = 0
+PLOT_PATHS = 3
+
+def read_stats(out_dir):
+    """Parse afl's fuzzer_stats into a dict of strings"""
+    stats = {}
+    with open(os.path.join(out_dir, 'fuzzer_stats')) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            stats[key.strip()] = value.strip()
+    return stats
+
+def read_plot_data(out_dir):
+    """Load afl's plot_data as (time since start, paths_total) rows"""
+    rows = []
+    with open(os.path.join(out_dir, 'plot_data')) as f:
+        for line in f:
+            if line.startswith('#'): continue
+            cols = line.split(',')
+            rows.append((int(cols[PLOT_TIME]), int(cols[PLOT_PATHS])))
+    return np.array(rows, dtype=np.int64).reshape(-1, 2)
+
+def paths_at(plot, start_time, checkpoints):
+    """Number of paths known at each checkpoint (seconds since start)"""
+    result = []
+    for t in checkpoints:
+        rows = plot[plot[:, 0] - start_time <= t]
+        result.append(int(rows[-1, 1]) if len(rows) else 0)
+    return result
+
+def run_campaign(run):
+    """Run afl-fuzz for one (config, repeat) and collect its metrics"""
+    try: os.makedirs(os.path.dirname(run['out_dir']))
+    except OSError: pass
+    cmd = [run['afl_fuzz']] + run['afl_args'] + ['-i', run['in_dir'], '-o', run['out_dir']]
+    if run['model']:
+        cmd += ['-P', run['model']]
+    cmd += ['--'] + run['target']
+
+    env = dict(os.environ)
+    env.update(AFL_NO_UI='1', AFL_SKIP_CPUFREQ='1', AFL_FIXED_SEED=str(run['seed']))
+    with open(run['out_dir'] + '.log', 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        deadline = time.time() + run['duration']
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.5)
+        if proc.poll() is None:
+            # afl writes its final stats and runs the model's exit hooks on SIGINT
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    result = dict(config=run['config'], repeat=run['repeat'], seed=run['seed'], returncode=proc.returncode)
+    try:
+        stats = read_stats(run['out_dir'])
+        plot = read_plot_data(run['out_dir'])
+    except (IOError, OSError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+    start_time = int(stats['start_time'])
+    elapsed = max(int(stats['last_update']) - start_time, 1)
+    execs = int(stats['execs_done'])
+    python_ms = int(stats.get('python_time_ms', 0))
+    startup_ms = int(stats.get('python_startup_ms', 0))
+    result.update(elapsed=elapsed,
+                  execs_done=execs,
+                  execs_per_sec=float(execs) / elapsed,
+                  paths_total=int(stats['paths_total']),
+                  bitmap_cvg=float(stats['bitmap_cvg'].rstrip('%')),
+                  python_pct=100.0 * python_ms / (1000.0 * elapsed),
+                  python_us_per_exec=1000.0 * python_ms / execs if execs else 0.0,
+                  python_startup_ms=startup_ms,
+                  paths_at=paths_at(plot, start_time, run['checkpoints']))
+    return result
+
+def summarize(results, checkpoints):
+    """Mean and standard deviation of every metric, per configuration"""
+    metrics = OrderedDict()
+    for key, label in [('execs_per_sec', 'exec/s'),
+                       ('paths_total', 'paths'),
+                       ('bitmap_cvg', 'map coverage %'),
+                       ('python_pct', 'python time %'),
+                       ('python_us_per_exec', 'python us/exec'),
+                       ('python_startup_ms', 'python startup ms')]:
+        metrics[label] = lambda r, key=key: r[key]
+    for i, t in enumerate(checkpoints):
+        metrics['paths @ %ds' % t] = lambda r, i=i: r['paths_at'][i]
+
+    summary = OrderedDict()
+    for config in OrderedDict((r['config'], None) for r in results):
+        runs = [r for r in results if r['config'] == config and 'error' not in r]
+        summary[config] = OrderedDict()
+        for label, get in metrics.items():
+            values = np.array([get(r) for r in runs], dtype=np.float64)
+            summary[config][label] = (values.mean(), values.std(ddof=1) if len(values) > 1 else 0.0) if len(values) else None
+    return summary
+
+def format_table(summary):
+    configs = list(summary)
+    labels = list(summary[configs[0]]) if configs else []
+    cell = lambda v: '-' if v is None else '%.2f +- %.2f' % v
+    rows = [[''] + configs] + [[label] + [cell(summary[c][label]) for c in configs] for label in labels]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(col.rjust(w) if i else col.ljust(w) for i, (col, w) in enumerate(zip(row, widths)))
+                     for row in rows)
+
+def parse_model(spec):
+    name, _, path = spec.partition('=')
+    if not name or not path:
+        raise argparse.ArgumentTypeError("expected NAME=PATH, got %r" % spec)
+    return name, os.path.abspath(path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', action='append', choices=list(CONFIGS),
+                        help='built-in configuration to run (default: all)')
+    parser.add_argument('-m', '--model', action='append', type=parse_model, default=[],
+                        help='NAME=PATH of an additional model to run')
+    parser.add_argument('-d', '--duration', type=int, default=300, help='seconds per run')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='runs per configuration')
+    parser.add_argument('-s', '--seed', type=int, default=1,
+                        help='AFL_FIXED_SEED of the first repeat; repeat n uses seed+n for every configuration')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='runs in parallel (afl binds each to a free core)')
+    parser.add_argument('-n', '--checkpoints', type=int, default=4,
+                        help='report paths at this many evenly spaced times')
+    parser.add_argument('-i', '--input', default=os.path.join(HERE, 'example_target', 'in'))
+    parser.add_argument('-w', '--workdir', help='where to keep the runs (default: a temporary directory, removed afterwards)')
+    parser.add_argument('--afl-fuzz', default=os.path.join(HERE, 'afl', 'afl-fuzz'))
+    parser.add_argument('--afl-args', default='-d -m 200', help='extra afl-fuzz arguments')
+    parser.add_argument('-o', '--output', help='also write the per-run results and summary as json')
+    parser.add_argument('target', nargs='*', default=[os.path.join(HERE, 'example_target', 'zlib.afl')],
+                        help='target command line (after --)')
+    args = parser.parse_args(argv)
+
+    configs = OrderedDict((name, CONFIGS[name]) for name in (args.config or CONFIGS))
+    configs.update(args.model)
+    checkpoints = [args.duration * (i + 1) // args.checkpoints for i in range(args.checkpoints)]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='wafl-bench-')
+
+    runs = [dict(config=name, model=model, repeat=r, seed=args.seed + r,
+                 out_dir=os.path.join(workdir, name, 'run%d' % r),
+                 afl_fuzz=os.path.abspath(args.afl_fuzz), afl_args=args.afl_args.split(),
+                 in_dir=os.path.abspath(args.input), target=args.target,
+                 duration=args.duration, checkpoints=checkpoints)
+            for r in range(args.repeats) for name, model in configs.items()]
+    print("running %d campaigns of %ds in %s" % (len(runs), args.duration, workdir))
+
+    pool = ThreadPool(args.jobs)
+    try:
+        results = sorted(pool.map(run_campaign, runs, chunksize=1), key=lambda r: (list(configs).index(r['config']), r['repeat']))
+    finally:
+        pool.close()
+        pool.join()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for r in results:
+        if 'error' in r:
+            sys.stderr.write("%s run %d failed (exit code %s): %s\n" % (r['config'], r['repeat'], r['returncode'], r['error']))
+    summary = summarize(results, checkpoints)
+    print(format_table(summary))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(checkpoints=checkpoints, runs=results, summary=summary), f, indent=2)
+
+if __name__ == '__main__':
+    main()
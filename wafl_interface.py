@@ -1,38 +1,89 @@
-import afl
+try:
+    import _afl # built into afl-fuzz
+    import afl
+except ImportError:
+    # not embedded in afl-fuzz, e.g. replaying a recording (see callback_record.py)
+    afl = None
 import alias_table
 
 import numpy as np
 import os
 
+from collections import namedtuple
+
+# Coverage change of a training vector relative to its seed, as computed by
+# afl: one of the afl.COV_* codes, the number of edges gained and lost, and
+# the (uint32) indices of up to afl.COV_MAX_EDGES changed edges as bytes, a
+# uniform sample of them when more changed.
+CovChange = namedtuple('CovChange', ['code', 'gained', 'lost', 'edges'])
+
+def kept_offsets(length, removed):
+    """Offsets of a buffer of the given length that survive removing the
+    (offset, length) ranges in removed, i.e. the old offset of each byte of
+    the trimmed buffer"""
+    mask = np.ones(length, dtype=bool)
+    for start, n in removed:
+        mask[start:start + n] = False
+    return np.flatnonzero(mask)
+
 class WAflInterface(object):
     """This mixin class maps from the low level C/Python Afl api to the higher level WAfl api"""
 
-    def __init__(self):
+    def __init__(self, want_coverage=True):
+        self._alias_paths = {}
+        self._recorder = None
+        if afl is None:
+            return
+        # models that only need afl's coverage change class can skip copying
+        # the whole coverage map on every exec
+        afl.post_fuzz_coverage(want_coverage)
         afl.notify_callback(self._notify_callback)
         afl.post_fuzz_callback(self._post_fuzz_callback)
         afl.new_entry_callback(self._new_entry_callback)
-        self._alias_paths = {}
+        afl.trim_callback(self._trim_callback)
+        afl.score_callback(self.seed_score)
+        # record the callbacks for offline replay if $WAFL_RECORD is set
+        if os.environ.get("WAFL_RECORD"):
+            from callback_record import CallbackRecorder
+            quota = int(os.environ["WAFL_RECORD_QUOTA"]) if "WAFL_RECORD_QUOTA" in os.environ else None
+            self._recorder = CallbackRecorder(os.environ["WAFL_RECORD"], quota)
+            afl.done(self._recorder.close)
 
     ### Low-Level API
 
-    def _post_fuzz_callback(self, id, fault, buf, cov, splicing_with, mutation_seq, old_cksum, new_cksum):
-        # TODO get the mutation_sequence from afl
-        self.got_training(id, buf, cov, mutation_seq, None if splicing_with == -1 else splicing_with, old_cksum, new_cksum)
+    def _post_fuzz_callback(self, id, fault, buf, cov, splicing_with, mutation_seq, old_cksum, new_cksum, cov_class, cov_gained, cov_lost, cov_edges):
+        if self._recorder is not None:
+            self._recorder.training(id, buf, splicing_with, old_cksum, new_cksum, cov_class, cov_gained, cov_lost, cov_edges)
+        self.got_training(id, buf, cov, mutation_seq, None if splicing_with == -1 else splicing_with, old_cksum, new_cksum,
+                          CovChange(cov_class, cov_gained, cov_lost, cov_edges))
 
     def _new_entry_callback(self, id, fault, fn, alias_fn, buf, cov):
         self._alias_paths[id] = alias_fn.decode()
         # in case this is a "re-discover" of a trimmed seed, erase stale alias tables
         try: os.remove(alias_fn)
         except OSError: pass
+        if self._recorder is not None:
+            self._recorder.new_seed(id, fault, buf)
         self.got_new_seed(id, buf, cov)
 
+    def _trim_callback(self, id, fault, fn, alias_fn, buf, cov, removed):
+        self._alias_paths[id] = alias_fn.decode()
+        # the length changed, so the old alias tables are stale
+        try: os.remove(alias_fn)
+        except OSError: pass
+        if self._recorder is not None:
+            self._recorder.trim(id, fault, buf, removed)
+        self.got_trimmed_seed(id, buf, cov, np.frombuffer(removed, dtype=np.uint32).reshape(-1, 2))
+
     def _notify_callback(self, _type, _id):
+        if self._recorder is not None:
+            self._recorder.notify(_type, _id)
         if _type == afl.NOTIFY_CYCLE_END:
             self.got_cycle_end(_id)
         elif _type == afl.NOTIFY_SEED_END:
             self.got_seed_end(_id)
         elif _type == afl.NOTIFY_SEED_START:
-            self.got_seed_start(_id)
+            return self.got_seed_start(_id)
         elif _type == afl.NOTIFY_CYCLE_START:
             self.got_cycle_start(_id)
         else:
@@ -44,9 +95,16 @@ class WAflInterface(object):
         """This function will be called when wafl adds a new seed to the queue"""
         raise NotImplementedError
 
-    def got_training(self, orig_seed_id, buf, cov, mutation_seq, splicing_with, old_cksum, new_cksum):
+    def got_trimmed_seed(self, seed_id, buf, cov, removed):
+        """This function will be called when afl trims a seed in the queue.
+           removed is a (n, 2) array of the (offset, length) ranges that were
+           cut from the old buffer.  By default the seed is treated as new."""
+        self.got_new_seed(seed_id, buf, cov)
+
+    def got_training(self, orig_seed_id, buf, cov, mutation_seq, splicing_with, old_cksum, new_cksum, cov_change=None):
         """This function will be called when wafl mutates a buffer and
-           calculates coverage for that buffer"""
+           calculates coverage for that buffer.  cov is None if the model
+           asked for the coverage change class (cov_change) only"""
         raise NotImplementedError
 
     def got_cycle_end(self, num):
@@ -62,16 +120,28 @@ class WAflInterface(object):
         pass
 
     def got_seed_start(self, num):
-        """This function will be called when a seed is about to be processed"""
+        """This function will be called when a seed is about to be processed.
+           It may return afl.SEED_UNIFORM to have afl sample the seed's
+           offsets uniformly this time and skip its training callbacks."""
         pass
 
+    def seed_score(self, seed_id):
+        """This function will be called before a seed is fuzzed.  It may
+           return a multiplier for afl's perf score (havoc time) of the seed,
+           or 0 to skip a seed that has been fuzzed before.  Keep it cheap;
+           None leaves the score alone."""
+        return None
+
     ### WAfl API methods
 
-    def save_weights(self, seed_id, weights):
+    def save_weights(self, seed_id, weights, wide_weights=()):
         """This function will save new weights for a seed.  Weights must be a
-           np.float64 array of percentage probabilities for each offset."""
+           np.float64 array of percentage probabilities for each offset.
+           wide_weights optionally holds the same for the start offsets of
+           word and dword mutations (len(weights) - 1 and len(weights) - 3
+           offsets); without them afl samples those from weights."""
         assert weights.dtype == np.float64
         path = self._alias_paths[seed_id]
-        alias, prob = alias_table.weights2alias(weights)
-        alias_table.write_alias(alias, prob, path)
+        tables = [alias_table.weights2alias(w) for w in (weights,) + tuple(wide_weights)]
+        alias_table.write_alias_tables(tables, path)
         return path
@@ -1,10 +1,8 @@
-from wafl_interface import WAflInterface
+from wafl_interface import WAflInterface, kept_offsets
 from util import fast_hash
 
 import numpy as np
 import os
-import shutil
-import json
 
 from collections import namedtuple, Counter, defaultdict
 Seed = namedtuple('Seed', ['buf', 'cov', 'id'])
@@ -17,6 +15,7 @@ class SimpleStats(defaultdict):
             super(SimpleStats, self).__init__(Counter)
 
     def dump(self, fname):
+        import json
         with open(fname, 'wb') as f:
             json.dump(self, f)
 
@@ -25,7 +24,119 @@ class SimpleStats(defaultdict):
         h = fast_hash(cov)
         self[seed][h] += 1
 
-class SimpleScheme(object):
+# CONSTANTS to depict change in coverage, these need to match COV_* in
+# afl's pycallback.h
+COV_NO_CHANGE = -1
+COV_CHANGE = 0
+COV_INCREASE = 1
+COV_SOFT_INCREASE = 2
+COV_SOFT_DECREASE = 3
+COV_DECREASE = 4
+
+# Registry of weighting schemes, keyed by name.  The scheme used by a model
+# can be picked at startup with the WAFL_SCHEME environment variable.
+SCHEMES = {}
+
+# Kinds of coverage ids a model passes to its scheme: afl's trace checksums,
+# which only say whether coverage differs from the seed's, or afl's COV_*
+# change classes.
+COV_IDS_CKSUM = 'checksum'
+COV_IDS_CLASS = 'class'
+
+def register_scheme(name):
+    """Class decorator that makes a weighting scheme selectable by name"""
+    def register(cls):
+        SCHEMES[name] = cls
+        return cls
+    return register
+
+def get_scheme(name, *args, **kwargs):
+    """Construct the weighting scheme registered under name"""
+    try:
+        cls = SCHEMES[name]
+    except KeyError:
+        raise ValueError("unknown weighting scheme %r (known: %s)" % (name, ", ".join(sorted(SCHEMES))))
+    return cls(*args, **kwargs)
+
+def check_scheme(scheme, cov_ids):
+    """Make sure scheme understands the kind of coverage ids a model passes"""
+    if cov_ids not in scheme.cov_ids:
+        raise ValueError("weighting scheme %s can't be used with %s coverage ids (it takes: %s)"
+                         % (type(scheme).__name__, cov_ids, ", ".join(scheme.cov_ids)))
+
+class WeightingScheme(object):
+    """Base class for pluggable weighting schemes.
+
+    A scheme owns the per-seed weight vectors: it creates them, updates them
+    from training vectors and turns them into a probability distribution.
+    Coverage is identified by ids that the scheme compares or interprets
+    itself; cov_ids lists the kinds (COV_IDS_*) it understands, so a model
+    can refuse a scheme that would misread its ids."""
+
+    cov_ids = ()
+
+    def initial_weights(self, buf, cov):
+        raise NotImplementedError
+
+    def update_weights(self, w, orig_buf, orig_cov, new_buf, cov_id, scale=1.0):
+        """Update weights given a single training vector"""
+        if len(orig_buf) != len(new_buf): return
+        new_bufs = np.frombuffer(new_buf, dtype=np.uint8).reshape(1, -1)
+        self.update_weights_batch(w, orig_buf, orig_cov, new_bufs, np.array([cov_id]), np.array([scale]))
+
+    def update_weights_batch(self, w, orig_buf, orig_cov, new_bufs_matrix, cov_ids, scales=None):
+        """Update weights given a batch of training vectors.
+
+        new_bufs_matrix is a (n, len(orig_buf)) uint8 matrix with one mutated
+        buffer per row and cov_ids holds the n matching coverage ids.  If
+        given, scales holds a multiplier for the reward of each row."""
+        if new_bufs_matrix.shape[1] != len(orig_buf): return
+        rows, offsets = self.changed_offsets(orig_buf, new_bufs_matrix)
+        self.update_weights_sparse(w, orig_cov, offsets, np.asarray(cov_ids)[rows],
+                                   None if scales is None else np.asarray(scales)[rows])
+
+    def update_weights_sparse(self, w, orig_cov, offsets, cov_ids, scales=None):
+        """Update weights given the changed offsets of many training vectors,
+        flattened into one array in training vector order, and the coverage
+        id (and optional reward multiplier) of the training vector each
+        offset came from."""
+        raise NotImplementedError
+
+    def decay_weights(self, w, factor):
+        """Scale the training in w down by factor (0 < factor < 1) in place"""
+        if not np.issubdtype(w.dtype, np.floating):
+            raise NotImplementedError("%s can't decay %s weights" % (type(self).__name__, w.dtype))
+        w *= factor
+
+    def normalize_weights(self, w):
+        """Normalize weights to a probability distribution (sum to 1)"""
+        n = w.astype(np.float64, copy=True)
+        c = float(np.sum(w))
+        if c != 0:
+            n /= c
+        return n
+
+    @staticmethod
+    def scale_rewards(adjustments, scales):
+        """Apply reward multipliers; penalties are left alone"""
+        if scales is None:
+            return adjustments
+        return np.where(adjustments > 0, adjustments * scales, adjustments)
+
+    @staticmethod
+    def changed_offsets(orig_buf, new_bufs_matrix):
+        """Return (rows, offsets) of every byte that differs from orig_buf"""
+        x = np.frombuffer(orig_buf, dtype=np.uint8)
+        return np.nonzero(new_bufs_matrix != x)
+
+
+@register_scheme('simple')
+class SimpleScheme(WeightingScheme):
+    """Rewards changed bytes when coverage differs from the seed's and
+    penalizes them otherwise.  Only compares ids, so either kind works."""
+
+    cov_ids = (COV_IDS_CKSUM, COV_IDS_CLASS)
+
     def __init__(self, max_weight=100, min_weight=1, initial_weight=1, reward=1, penalty=-1):
         self.max_weight = max_weight
         self.min_weight = min_weight
@@ -41,7 +152,7 @@ class SimpleScheme(object):
     def initial_weights(self, buf, cov):
         return np.full(shape=len(buf), fill_value=self.initial_weight, dtype=np.uint8)
 
-    def update_weights(self, w, orig_buf, orig_cov, new_buf, new_cov):
+    def update_weights(self, w, orig_buf, orig_cov, new_buf, cov_id, scale=1.0):
         """Update weights given a single training vector"""
 
         # we don't handle changed lengths
@@ -50,34 +161,109 @@ class SimpleScheme(object):
         # which bytes changed?
         x = np.frombuffer(orig_buf, dtype=np.uint8)
         y = np.frombuffer(new_buf, dtype=np.uint8)
-        mask = (x!=y)
+        idx = np.flatnonzero(x != y)
 
         # did the coverage change?
-        if orig_cov != new_cov:
-            adjustment = self.reward
-            print("cov changed due to", mask.nonzero(), adjustment)
-        else:
-            adjustment = self.penalty
+        adjustment = self.reward * scale if cov_id != orig_cov else self.penalty
+
+        # boost/penalize the changed bytes, preventing under/overflow.  The
+        # offsets are unique so a fancy-indexed update is safe here.
+        w[idx] = np.clip(w[idx].astype(np.float64) + adjustment, self.min_weight, self.max_weight)
+
+    def decay_weights(self, w, factor):
+        """Move the weights back towards initial_weight, rounding to the
+        integer weights this scheme uses"""
+        decayed = self.initial_weight + (w.astype(np.float64) - self.initial_weight) * factor
+        w[:] = np.clip(np.rint(decayed), self.min_weight, self.max_weight)
+
+    def update_weights_sparse(self, w, orig_cov, offsets, cov_ids, scales=None):
+        """Clips after every training vector, like update_weights, so a batch
+        learns the same weights as its vectors one at a time: the first
+        adjustment of every offset is applied at once, then the second, ..."""
+        if not len(offsets): return
+        adjustments = np.where(cov_ids != orig_cov, self.reward, self.penalty).astype(np.float64)
+        adjustments = self.scale_rewards(adjustments, scales)
+        # group by offset; the stable sort keeps each offset's adjustments in
+        # training vector order
+        order = np.argsort(offsets, kind='stable')
+        offsets, adjustments = offsets[order], adjustments[order]
+        # rank of every adjustment among those of its offset
+        n = np.arange(len(offsets))
+        first = np.r_[True, offsets[1:] != offsets[:-1]]
+        rank = n - np.maximum.accumulate(np.where(first, n, 0))
+        by_rank = np.argsort(rank, kind='stable')
+        start = 0
+        for count in np.bincount(rank):
+            # offsets are unique within a rank
+            sel = by_rank[start:start + count]
+            idx = offsets[sel]
+            w[idx] = np.clip(w[idx].astype(np.float64) + adjustments[sel], self.min_weight, self.max_weight)
+            start += count
+
 
-        # boost/penalize the changed bytes
-        np.add.at(w, mask.nonzero(), adjustment)
+@register_scheme('reward')
+class RewardScheme(WeightingScheme):
+    """Rewards/penalizes changed bytes according to the COV_* class of the
+    coverage change.  The coverage ids given to this scheme are COV_* codes."""
 
-        # prevent under/overflow
-        np.clip(w, self.min_weight, self.max_weight, out=w)
+    cov_ids = (COV_IDS_CLASS,)
+
+    def __init__(self, alpha=0.5, beta=0.4, gamma=0.3, delta=0.2, epsilon=0.1):
+        # Save off params for rewarding/penalizing training
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.delta = delta
+        self.epsilon = epsilon
+        # reward lookup table indexed by (COV_* code - COV_NO_CHANGE)
+        self.rewards = np.array([
+            -self.epsilon, # COV_NO_CHANGE, this is terrible outcome, says danny.
+            self.beta,     # COV_CHANGE
+            1.0,           # COV_INCREASE
+            self.alpha,    # COV_SOFT_INCREASE
+            self.gamma,    # COV_SOFT_DECREASE
+            -self.delta,   # COV_DECREASE
+            ], dtype=np.float64)
+
+    def reward(self, cov_change):
+        return self.rewards[cov_change - COV_NO_CHANGE]
+
+    def initial_weights(self, buf, cov):
+        return np.zeros(len(buf), dtype=np.float64)
 
     def normalize_weights(self, w):
-        """Normalize weights to a probability distribution (sum to 1)"""
-        n = w.astype(np.float64, copy=True)
-        c = float(np.sum(w))
-        n /= c
-        return n
+        """Normalize weights to a probability distribution.  Penalties can
+        push weights below zero, which an alias table can't represent, so
+        those offsets get no probability mass."""
+        return super(RewardScheme, self).normalize_weights(np.clip(w, 0, None))
+
+    def update_weights(self, w, orig_buf, orig_cov, new_buf, cov_id, scale=1.0):
+        """Update weights given a single training vector"""
+        if len(orig_buf) != len(new_buf): return
+        x = np.frombuffer(orig_buf, dtype=np.uint8)
+        y = np.frombuffer(new_buf, dtype=np.uint8)
+        reward = self.reward(cov_id)
+        if reward > 0:
+            reward *= scale
+        # offsets are unique so a fancy-indexed update is safe here
+        w[np.flatnonzero(x != y)] += reward
+
+    def update_weights_sparse(self, w, orig_cov, offsets, cov_ids, scales=None):
+        adjustments = self.scale_rewards(self.rewards[cov_ids - COV_NO_CHANGE], scales)
+        w += np.bincount(offsets, weights=adjustments, minlength=len(w))
 
 
 class WAflSimple(WAflInterface):
-    def __init__(self, scheme=None, save_incremental_dir=None, stats=None, profile=None):
-        super(WAflSimple, self).__init__()
+    def __init__(self, scheme=None, save_incremental_dir=None, stats=None, profile=None, batch_size=256):
+        # coverage is identified by afl's trace checksums; the full map is
+        # only needed for stats
+        super(WAflSimple, self).__init__(want_coverage=stats is not None)
         if scheme is None:
             scheme = SimpleScheme()
+        # coverage ids are afl's trace checksums
+        check_scheme(scheme, COV_IDS_CKSUM)
+        self.batch_size = batch_size
+        self.pending = {} # structure will be {seed_id: (old_cksum, [bufs], [cksums])}
         self.stats = stats
         self.save_incremental_dir = save_incremental_dir
         self.seeds = {}
@@ -90,21 +276,51 @@ class WAflSimple(WAflInterface):
             except OSError: pass
 
     def got_new_seed(self, seed_id, buf, cov):
+        self.pending.pop(seed_id, None)
         self.seeds[seed_id] = Seed(buf=buf, cov=cov, id=seed_id)
         self.weights[seed_id] = self.scheme.initial_weights(buf, cov)
 
-    def got_training(self, orig_seed_id, buf, cov, mutation_seq, splicing_with, old_cksum, new_cksum):
+    def got_trimmed_seed(self, seed_id, buf, cov, removed):
+        if seed_id not in self.seeds:
+            return self.got_new_seed(seed_id, buf, cov)
+        # finish training on the old buffer, then keep the weights of the
+        # bytes that survived and publish them for the upcoming havoc stage
+        self.flush_training(seed_id)
+        kept = kept_offsets(len(self.seeds[seed_id].buf), removed)
+        self.seeds[seed_id] = Seed(buf=buf, cov=cov, id=seed_id)
+        self.weights[seed_id] = self.weights[seed_id][kept]
+        self.write_weights(seed_id)
+
+    def got_training(self, orig_seed_id, buf, cov, mutation_seq, splicing_with, old_cksum, new_cksum, cov_change=None):
         seed = self.seeds[orig_seed_id]
-        weights = self.weights[orig_seed_id]
-        self.scheme.update_weights(weights, seed.buf, seed.cov, buf, cov)
         if self.stats is not None: self.stats.witness(orig_seed_id, buf, cov)
+        # we don't handle changed lengths
+        if len(buf) != len(seed.buf): return
+        # queue the training vector; the trace checksums identify coverage
+        _, bufs, cksums = self.pending.setdefault(orig_seed_id, (old_cksum, [], []))
+        bufs.append(buf)
+        cksums.append(new_cksum)
+        if len(bufs) >= self.batch_size:
+            self.flush_training(orig_seed_id)
+
+    def flush_training(self, seed_id):
+        """Apply all queued training vectors for seed_id in one batch"""
+        if seed_id not in self.pending: return
+        old_cksum, bufs, cksums = self.pending.pop(seed_id)
+        seed = self.seeds[seed_id]
+        new_bufs = np.frombuffer(b''.join(bufs), dtype=np.uint8).reshape(len(bufs), len(seed.buf))
+        self.scheme.update_weights_batch(self.weights[seed_id], seed.buf, old_cksum, new_bufs, np.array(cksums, dtype=np.int64))
 
     def got_cycle_start(self, num):
         self.curr_cycle = num
 
     def got_seed_end(self, seed_id):
-        weights = self.weights[seed_id]
-        norm = self.scheme.normalize_weights(weights)
+        self.flush_training(seed_id)
+        self.write_weights(seed_id)
+
+    def write_weights(self, seed_id):
+        """Normalize a seed's weights and write them out to afl"""
+        norm = self.scheme.normalize_weights(self.weights[seed_id])
         alias_fname = self.save_weights(seed_id, norm)
         self.save_incremental(alias_fname, norm)
 
@@ -122,6 +338,7 @@ class WAflSimple(WAflInterface):
             try: os.mkdir(dest_dir)
             except OSError: pass
             # save the alias table
+            import shutil
             shutil.copy(alias_fname, dest_dir)
             # save the normalized weights
             weights_fname = '%s/%s.weights' % (dest_dir, os.path.basename(alias_fname))
@@ -129,14 +346,16 @@ class WAflSimple(WAflInterface):
                 f.write(norm.tobytes())
 
 if __name__ == '__main__':
-    import cProfile
-    profile = cProfile.Profile()
-    profile.enable()
+    # WAFL_PROFILE=sample (statistical, low overhead) or WAFL_PROFILE=cprofile
+    from sampling_profiler import profiler_from_env
+    profile = profiler_from_env()
 
     savedir = os.environ["SAVE_DIR"] if "SAVE_DIR" in os.environ else None
 
+    scheme = os.environ["WAFL_SCHEME"] if "WAFL_SCHEME" in os.environ else "simple"
+
     wafl = WAflSimple(
-        scheme=SimpleScheme(),
+        scheme=get_scheme(scheme),
         # stats=SimpleStats(),
-        # profile=profile,
+        profile=profile,
         save_incremental_dir=savedir)
@@ -0,0 +1,130 @@
+"""
+Sweep WAflModel's reward parameters (alpha..epsilon) offline.
+
+Record a campaign once by running afl-fuzz with WAFL_RECORD=<dir>, then replay
+the recording through WAflModel for every parameter vector in parallel:
+
+    python wafl_sweep.py <dir> -p alpha=0.1,0.5,1 -p epsilon=0,0.1 -j 8
+
+Each configuration is scored by the probability mass its weights placed on
+the offsets that went on to produce COV_INCREASE, measured just before the
+model trains on that exec, relative to a uniform distribution (lift > 1 is
+better than uniform).
+"""
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+from callback_record import load_recording, replay
+from wafl import WAflModel, COV_INCREASE
+
+PARAMS = ('alpha', 'beta', 'gamma', 'delta', 'epsilon')
+DEFAULTS = dict(alpha=0.5, beta=0.4, gamma=0.3, delta=0.2, epsilon=0.1)
+
+class ScoringModel(WAflModel):
+    """WAflModel that scores its weights against the recorded increases"""
+
+    def __init__(self, **params):
+        super(ScoringModel, self).__init__(**params)
+        self.mass = 0.0
+        self.uniform_mass = 0.0
+        self.increases = 0
+
+    def got_training(self, seed_id, new_bytes, cov_new, mutation_seq, splicing_with, old_cksum, new_cksum, cov_change=None):
+        seed_bytes = self.seed_table[seed_id]
+        if cov_change.code == COV_INCREASE and splicing_with is None and len(new_bytes) == len(seed_bytes):
+            changed = np.flatnonzero(seed_bytes != np.frombuffer(new_bytes, dtype=np.uint8))
+            if len(changed):
+                self.flush_training()
+                self.mass += self.probability(self.weight_table[seed_id], changed)
+                self.uniform_mass += float(len(changed)) / len(seed_bytes)
+                self.increases += 1
+        return super(ScoringModel, self).got_training(seed_id, new_bytes, cov_new, mutation_seq,
+                                                      splicing_with, old_cksum, new_cksum, cov_change)
+
+    def probability(self, weights, offsets):
+        """Probability of hitting offsets when sampling from weights"""
+        dist = self.normalize_weights(weights)
+        total = dist.sum()
+        if total <= 0:
+            return float(len(offsets)) / len(weights)
+        return dist[offsets].sum() / total
+
+    def save_weights(self, seed_id, weights_norm, wide_norms=()):
+        pass
+
+    def save_incremental(self, alias_fname, norm):
+        pass
+
+_recording = None
+
+def _init_worker(path):
+    global _recording
+    # the recording is memory mapped, so workers share the page cache
+    _recording = load_recording(path)
+    sys.stdout = open(os.devnull, 'w')
+
+def score(params):
+    model = ScoringModel(**params)
+    replay(model, *_recording)
+    result = dict(params)
+    result['increases'] = model.increases
+    result['score'] = model.mass / model.increases if model.increases else 0.0
+    result['lift'] = model.mass / model.uniform_mass if model.uniform_mass else 0.0
+    return result
+
+def parse_param(spec):
+    name, _, values = spec.partition('=')
+    if name not in PARAMS:
+        raise argparse.ArgumentTypeError("unknown parameter %r, expected one of %s" % (name, ", ".join(PARAMS)))
+    try:
+        return name, [float(v) for v in values.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("bad values for %s: %r" % (name, values))
+
+def make_grid(specs, samples=None, seed=None):
+    """Cartesian product of the given values, or random samples within their
+       ranges if samples is set"""
+    values = dict((k, [v]) for k, v in DEFAULTS.items())
+    values.update(specs)
+    if samples:
+        rng = np.random.RandomState(seed)
+        return [dict((k, rng.uniform(min(values[k]), max(values[k]))) for k in PARAMS) for _ in range(samples)]
+    return [dict(zip(PARAMS, combo)) for combo in itertools.product(*(values[k] for k in PARAMS))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', help='directory recorded with WAFL_RECORD')
+    parser.add_argument('-p', '--param', action='append', type=parse_param, default=[],
+                        help='NAME=V1,V2,... values to sweep (default: wafl.py defaults)')
+    parser.add_argument('-n', '--samples', type=int,
+                        help='sample this many random vectors within the ranges of the given values')
+    parser.add_argument('--seed', type=int, help='random seed for --samples')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('-o', '--output', help='write results as csv (default: stdout)')
+    args = parser.parse_args(argv)
+
+    grid = make_grid(dict(args.param), args.samples, args.seed)
+    pool = multiprocessing.Pool(args.jobs, initializer=_init_worker, initargs=(args.recording,))
+    try:
+        results = pool.map(score, grid, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    results.sort(key=lambda r: r['lift'], reverse=True)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    writer = csv.DictWriter(out, fieldnames=list(PARAMS) + ['increases', 'score', 'lift'])
+    writer.writeheader()
+    writer.writerows(results)
+    if args.output:
+        out.close()
+
+if __name__ == '__main__':
+    main()